@@ -0,0 +1,121 @@
+"""
+Content-addressed cache for Keep attachments.
+
+Keep notes often share the same photo. What was worked out for an attachment
+file, its MD5, size and image dimensions, is remembered by the file's path,
+size and modification time, so the file isn't read and hashed again. The
+base64 encoding of the data is remembered by its MD5, so a later attachment
+with the same data is written without reading or encoding it again.
+
+Encodings are kept in memory up to a budget, evicting the least recently
+used first. An encoding larger than an eighth of the budget is spilled to a
+temporary file instead, once its data turns up a second time. Only the
+encodings in memory outlive a conversion, see endConversion.
+"""
+import os, shutil, tempfile
+from collections import OrderedDict
+
+class EncodingWriter:
+    """
+    Collects an encoding while it is written out, it is added to the cache
+    by commit() once complete
+    """
+    def __init__(self, cache, md5, spillPath=None):
+        self.cache = cache
+        self.md5 = md5
+        self.spillPath = spillPath
+        self.parts = []
+        self.spillFile = open(spillPath, "w", encoding="ascii") if spillPath else None
+
+    def write(self, data):
+        if self.spillFile is not None:
+            self.spillFile.write(data)
+        else:
+            self.parts.append(data)
+
+    def commit(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.cache.spilled[self.md5] = self.spillPath
+        else:
+            self.cache.addEncoding(self.md5, "".join(self.parts))
+
+    def discard(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            os.remove(self.spillPath)
+        self.parts = []
+
+class AttachmentCache:
+    def __init__(self, memoryBudget):
+        self.memoryBudget = memoryBudget
+        self.spillSize = memoryBudget // 8
+        # (path, size, mtime) -> (md5, size, width, height)
+        self.files = {}
+        # md5 -> base64 encoding, least recently used first
+        self.encodings = OrderedDict()
+        self.memoryUsed = 0
+        # md5 -> path of a spilled encoding
+        self.spilled = {}
+        # md5s of large encodings written once, spilled when seen again
+        self.seenLarge = set()
+        self.spillDir = None
+
+    def fileInfo(self, key):
+        return self.files.get(key)
+
+    def addFileInfo(self, key, info):
+        self.files[key] = info
+
+    def addEncoding(self, md5, encoding):
+        self.encodings[md5] = encoding
+        self.memoryUsed += len(encoding)
+        while self.memoryUsed > self.memoryBudget:
+            _, evicted = self.encodings.popitem(last=False)
+            self.memoryUsed -= len(evicted)
+
+    def writeEncoding(self, md5, write, chunkSize):
+        "Writes a cached encoding of md5 in pieces of chunkSize, returns False when there is none"
+        if md5 in self.encodings:
+            self.encodings.move_to_end(md5)
+            write(self.encodings[md5])
+            return True
+        if md5 in self.spilled:
+            with open(self.spilled[md5], "r", encoding="ascii") as f:
+                while True:
+                    data = f.read(chunkSize)
+                    if not data: break
+                    write(data)
+            return True
+        return False
+
+    def encodingWriter(self, md5, dataSize):
+        "Returns an EncodingWriter for data of dataSize bytes, or None when it isn't to be cached"
+        if self.memoryBudget <= 0:
+            return None
+        if (dataSize + 2) // 3 * 4 <= self.spillSize:
+            return EncodingWriter(self, md5)
+        if md5 not in self.seenLarge:
+            self.seenLarge.add(md5)
+            return None
+        if self.spillDir is None:
+            self.spillDir = tempfile.mkdtemp(prefix="keepToEnex-")
+        return EncodingWriter(self, md5, os.path.join(self.spillDir, md5 + ".b64"))
+
+    def endConversion(self):
+        """
+        Forgets the attachment files and removes the spilled encodings. The
+        file infos take memory per attachment, not counted in the budget,
+        the encodings in memory are kept for the next conversion
+        """
+        self.files.clear()
+        self.spilled.clear()
+        self.seenLarge.clear()
+        if self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+
+    def close(self):
+        self.encodings.clear()
+        self.memoryUsed = 0
+        self.endConversion()
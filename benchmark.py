@@ -0,0 +1,239 @@
+"""
+Measures conversion throughput on synthetic exports.
+
+Generates a Google Takeout zip of Keep notes and a directory of OneNote .mht
+sections, converts them with keepToEnex and onenoteToEnex, and reports
+notes/sec, MB/sec, peak RSS and the time spent in each stage, as recorded
+by the converters' instrumentation (see instrument.py). Each
+conversion runs in its own process so that peak RSS is measured per run.
+
+    python benchmark.py --notes 5000 --attachmentKB 300 --keepOptions "--jobs 4"
+    python benchmark.py --only onenote --sections 20 --images 40 --json bench.json
+"""
+from __future__ import print_function
+import sys, os, json, time, random, zipfile, base64, struct, zlib, argparse, shlex, shutil, subprocess, tempfile, resource
+from datetime import datetime, timedelta
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+def msg(s):
+    print(s, file=sys.stderr)
+    sys.stderr.flush()
+
+def words(rnd, count):
+    return " ".join(rnd.choice(WORDS) for i in range(count))
+
+def fakePng(rnd, size):
+    "Random bytes of roughly size, with a PNG signature and IHDR so the header probe can size it"
+    width, height = rnd.randint(16, 4000), rnd.randint(16, 4000)
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + ihdr + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr))
+    return header + os.urandom(max(size - len(header), 0))
+
+def makeTakeoutZip(path, options):
+    """
+    Writes a Takeout zip with options.notes Keep notes, options.listRatio of
+    them checklists, labels drawn from options.labels names and an attachment
+    of about options.attachmentKB on options.attachmentRatio of them
+    """
+    rnd = random.Random(options.seed)
+    start = datetime(2015, 1, 1)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        # other products' data, which the converter should not need to touch
+        z.writestr("Takeout/archive_browser.html", "<html></html>")
+        z.writestr("Takeout/Drive/data.bin", os.urandom(options.otherKB * 1024), zipfile.ZIP_STORED)
+
+        for i in range(options.notes):
+            edited = start + timedelta(minutes=rnd.randint(0, 5 * 365 * 24 * 60))
+            note = {
+                "color": "DEFAULT",
+                "isTrashed": False,
+                "isPinned": rnd.random() < 0.05,
+                "isArchived": rnd.random() < 0.2,
+                "title": words(rnd, rnd.randint(0, 6)),
+                "userEditedTimestampUsec": int((edited - datetime(1970, 1, 1)).total_seconds() * 1000000),
+                "labels": [{"name": "label %d" % rnd.randrange(options.labels)} for l in range(rnd.randint(0, 2))] if options.labels else [],
+            }
+            if rnd.random() < options.listRatio:
+                note["listContent"] = [{"text": words(rnd, rnd.randint(1, 8)), "isChecked": rnd.random() < 0.5}
+                                       for l in range(rnd.randint(1, 15))]
+            else:
+                note["textContent"] = "\n".join(words(rnd, rnd.randint(3, 30)) for l in range(rnd.randint(1, 10)))
+
+            if rnd.random() < options.attachmentRatio:
+                name = "%s.png" % i
+                size = int(options.attachmentKB * 1024 * rnd.uniform(0.5, 1.5))
+                z.writestr("Takeout/Keep/" + name, fakePng(rnd, size), zipfile.ZIP_STORED)
+                note["attachments"] = [{"filePath": name, "mimetype": "image/png"}]
+
+            z.writestr("Takeout/Keep/%s.json" % i, json.dumps(note))
+
+def makeMhtSection(path, options, rnd):
+    """
+    Writes a OneNote section export with options.notes pages and
+    options.images images of about options.imageKB, referenced from random pages
+    """
+    boundary = "----=_NextPart_01D00000.00000000"
+    images = ["image%03d.png" % i for i in range(options.images)]
+    start = datetime(2015, 1, 1)
+
+    pages = []
+    for i in range(options.notes):
+        created = start + timedelta(minutes=rnd.randint(0, 5 * 365 * 24 * 60))
+        paragraphs = "".join('<p style="margin:0in;font-family:Calibri;font-size:11.0pt"><span lang=en-US style="font-weight:bold">%s</span></p>'
+                             % words(rnd, rnd.randint(5, 40)) for p in range(rnd.randint(1, 10)))
+        if images and rnd.random() < 0.5:
+            paragraphs += '<p><img width=100 height=100 src="section_files/%s" alt="image"></p>' % rnd.choice(images)
+        pages.append('<div style="direction:ltr"><div style="direction:ltr;margin-top:0in">'
+                     '<div><p style="font-size:20.0pt;font-family:Calibri Light">%s</p></div>'
+                     '<div><p style="font-size:10.0pt;color:#767676">%s</p></div>%s</div></div>'
+                     % (words(rnd, rnd.randint(1, 6)), created.strftime("%A, %B %d, %Y %I:%M %p"), paragraphs))
+    html = "<html><head><meta charset=utf-8></head><body lang=en-US style='font-family:Calibri'>%s</body></html>" % "\n".join(pages)
+
+    with open(path, "wb") as f:
+        f.write(("MIME-Version: 1.0\r\nContent-Type: multipart/related; boundary=\"%s\"\r\n\r\n" % boundary).encode("ascii"))
+        f.write(("--%s\r\nContent-Location: file:///C:/section.htm\r\nContent-Transfer-Encoding: base64\r\n"
+                 "Content-Type: text/html; charset=\"utf-8\"\r\n\r\n" % boundary).encode("ascii"))
+        f.write(base64.encodebytes(html.encode("utf-8")).replace(b"\n", b"\r\n"))
+        for name in images:
+            data = fakePng(rnd, int(options.imageKB * 1024 * rnd.uniform(0.5, 1.5)))
+            f.write(("\r\n--%s\r\nContent-Location: file:///C:/section_files/%s\r\nContent-Transfer-Encoding: base64\r\n"
+                     "Content-Type: image/png\r\n\r\n" % (boundary, name)).encode("ascii"))
+            f.write(base64.encodebytes(data).replace(b"\n", b"\r\n"))
+        f.write(("\r\n--%s--\r\n" % boundary).encode("ascii"))
+
+def makeOnenoteDir(path, options):
+    rnd = random.Random(options.seed)
+    os.mkdir(path)
+    for i in range(options.sections):
+        makeMhtSection(os.path.join(path, "section%d.mht" % i), options, rnd)
+
+def dirSize(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(path) for f in files)
+
+def peakRssMB():
+    "Peak resident set size of this process or any of its finished children"
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+def converterReport(run, reportPath):
+    "Runs a conversion with the converter's own instrumentation on, returning its report"
+    import instrument
+    instrument.run(run, reportPath)
+    with open(reportPath) as f:
+        return json.load(f)
+
+def runKeep(zipPath, converterOptions):
+    import keepToEnex
+    reportPath = zipPath + ".report.json"
+    options = keepToEnex.KeepOptions.fromArgs(keepToEnex.getArgs([zipPath] + converterOptions))
+    report = converterReport(lambda: keepToEnex.convertKeep(zipPath, options), reportPath)
+    outputDir = os.path.join(os.path.dirname(zipPath), "Evernote_Files")
+    return report, dirSize(outputDir)
+
+def runOnenote(mhtDir, converterOptions):
+    import glob, onenoteToEnex
+    inputs = set(glob.glob(os.path.join(mhtDir, "*.mht")))
+    reportPath = os.path.join(os.path.dirname(mhtDir), "onenote.report.json")
+    options = onenoteToEnex.MhtOptions.from_args(onenoteToEnex.getArgs([mhtDir, "--sort", "created"] + converterOptions))
+    report = converterReport(lambda: onenoteToEnex.convert_mht(mhtDir, options), reportPath)
+    return report, dirSize(mhtDir) - sum(os.path.getsize(p) for p in inputs)
+
+def runChild(kind, inputPath, converterOptions):
+    "Runs one conversion with the converter's output silenced, printing the result as json"
+    out = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    start = time.perf_counter()
+    report, outputBytes = (runKeep if kind == "keep" else runOnenote)(inputPath, converterOptions)
+    result = {
+        "seconds": time.perf_counter() - start,
+        "stages": report["stages"],
+        "counters": report["counters"],
+        "outputBytes": outputBytes,
+        "peakRssMB": peakRssMB(),
+    }
+    out.write(json.dumps(result) + "\n")
+    out.close()
+
+def measure(kind, inputPath, notes, inputBytes, converterOptions):
+    command = [sys.executable, os.path.abspath(__file__), "--child", kind, inputPath, "--converterOptions=" + " ".join(converterOptions)]
+    proc = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result.update({
+        "converter": kind,
+        "notes": notes,
+        "inputMB": inputBytes / 1e6,
+        "outputMB": result.pop("outputBytes") / 1e6,
+        "notesPerSec": notes / result["seconds"],
+        "MBPerSec": inputBytes / 1e6 / result["seconds"],
+    })
+    return result
+
+def report(result):
+    print("%(converter)s: %(notes)i notes, %(inputMB).1f MB in, %(outputMB).1f MB out, %(seconds).2fs" % result)
+    print("    %(notesPerSec).1f notes/sec, %(MBPerSec).2f MB/sec, peak RSS %(peakRssMB).1f MB" % result)
+    for name, times in result["stages"].items():
+        print("    %-24s wall %8.3fs  cpu %8.3fs  calls %8i" % (name, times["wall"], times["cpu"], times["calls"]))
+    print("    " + ", ".join("%s: %s" % item for item in result["counters"].items()))
+
+def getArgs(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", choices=["keep", "onenote"], default=None)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--notes", default=1000, type=int, help="Keep notes, or pages per OneNote section")
+    parser.add_argument("--listRatio", default=0.3, type=float)
+    parser.add_argument("--labels", default=10, type=int)
+    parser.add_argument("--attachmentRatio", default=0.2, type=float)
+    parser.add_argument("--attachmentKB", default=200, type=float)
+    parser.add_argument("--otherKB", default=1024, type=int, help="size of the non-Keep data in the zip")
+    parser.add_argument("--sections", default=5, type=int)
+    parser.add_argument("--images", default=20, type=int, help="images per OneNote section")
+    parser.add_argument("--imageKB", default=100, type=float)
+    parser.add_argument("--keepOptions", default="", help="extra keepToEnex options, e.g. \"--jobs 4\"")
+    parser.add_argument("--onenoteOptions", default="", help="extra onenoteToEnex options")
+    parser.add_argument("--workDir", default=None, help="kept after the run when given")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    parser.add_argument("--child", nargs=2, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--converterOptions", default="", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main():
+    args = getArgs()
+
+    if args.child:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        return runChild(args.child[0], args.child[1], shlex.split(args.converterOptions))
+
+    workDir = args.workDir or tempfile.mkdtemp(prefix="enex-benchmark-")
+    results = []
+    try:
+        if args.only in (None, "keep"):
+            keepDir = os.path.join(workDir, "keep")
+            os.makedirs(keepDir)
+            zipPath = os.path.join(keepDir, "takeout.zip")
+            msg("Generating %s ..." % zipPath)
+            makeTakeoutZip(zipPath, args)
+            results.append(measure("keep", zipPath, args.notes, os.path.getsize(zipPath), shlex.split(args.keepOptions)))
+            report(results[-1])
+
+        if args.only in (None, "onenote"):
+            mhtDir = os.path.join(workDir, "onenote")
+            msg("Generating %s ..." % mhtDir)
+            makeOnenoteDir(mhtDir, args)
+            results.append(measure("onenote", mhtDir, args.notes * args.sections, dirSize(mhtDir), shlex.split(args.onenoteOptions)))
+            report(results[-1])
+    finally:
+        if not args.workDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Mako templates shared by keepToEnex and onenoteToEnex.
+
+The templates in templates/ are compiled once, when they are first used,
+instead of once per note, and stay compiled for the life of the process.
+Mako itself is only imported then. Set ENEX_TEMPLATE_CACHE to a directory to
+have mako keep the compiled template modules there, so later runs skip
+compilation.
+"""
+import os
+
+templateDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+moduleDir = os.environ.get("ENEX_TEMPLATE_CACHE") or None
+
+lookup = None
+
+# keepNoteEnex and onenoteSectionNoteEnex render a single <note>, written
+# between exportHeader and exportFooter so that several notes can share one
+# export file
+exportHeader = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export4.dtd">
+<en-export application="Evernote" version="Evernote">
+"""
+exportFooter = "</en-export>\n"
+
+templateFiles = {
+    "keepNoteEnex": "keepNote.enex",
+    "onenoteNoteEnex": "onenoteNote.enex",
+    # a single <note> whose contents are streamed by its writeContents()
+    # callback, for --singleEnex
+    "onenoteSectionNoteEnex": "onenoteSectionNote.enex",
+    "onenoteNoteHtml": "onenoteNote.html",
+}
+
+def __getattr__(name):
+    "Compiles enexTemplates.keepNoteEnex and the others when first asked for"
+    global lookup
+    if name not in templateFiles:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    if lookup is None:
+        from mako.lookup import TemplateLookup
+        lookup = TemplateLookup(directories=[templateDir], module_directory=moduleDir, input_encoding="utf-8")
+    template = lookup.get_template(templateFiles[name])
+    globals()[name] = template
+    return template
@@ -0,0 +1,67 @@
+"""
+Reads image dimensions from the first bytes of a PNG, JPEG, GIF or WebP
+file, without decoding the image.
+"""
+import struct
+
+# JPEG start-of-frame markers, which carry the image size
+jpegSofMarkers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers without a length field
+jpegStandaloneMarkers = set(range(0xD0, 0xDA)) | {0x01}
+
+def pngSize(header):
+    if header[12:16] != b"IHDR": return None
+    return struct.unpack(">II", header[16:24])
+
+def gifSize(header):
+    return struct.unpack("<HH", header[6:10])
+
+def webpSize(header):
+    chunk = header[12:16]
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b"VP8L" and header[20:21] == b"\x2f":
+        b0, b1, b2, b3 = header[21:25]
+        return 1 + (b0 | (b1 & 0x3f) << 8), 1 + (b1 >> 6 | b2 << 2 | (b3 & 0x0f) << 10)
+    if chunk == b"VP8X":
+        return 1 + int.from_bytes(header[24:27], "little"), 1 + int.from_bytes(header[27:30], "little")
+    return None
+
+def jpegSize(header):
+    i = 2
+    while i + 9 < len(header):
+        if header[i] != 0xFF: return None
+        marker = header[i + 1]
+        if marker == 0xFF:
+            i += 1
+        elif marker in jpegStandaloneMarkers:
+            i += 2
+        elif marker in jpegSofMarkers:
+            height, width = struct.unpack(">HH", header[i + 5:i + 9])
+            return width, height
+        else:
+            i += 2 + struct.unpack(">H", header[i + 2:i + 4])[0]
+    return None
+
+def probeSize(header):
+    """
+    Returns (width, height) read from the header bytes of an image, or None
+    when the format is not recognised or the size lies beyond the header
+    """
+    try:
+        if header.startswith(b"\x89PNG\r\n\x1a\n"):
+            size = pngSize(header)
+        elif header[:6] in (b"GIF87a", b"GIF89a"):
+            size = gifSize(header)
+        elif header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            size = webpSize(header)
+        elif header.startswith(b"\xff\xd8"):
+            size = jpegSize(header)
+        else:
+            size = None
+    except (struct.error, ValueError):
+        return None
+
+    if size and size[0] and size[1]: return tuple(size)
+    return None
@@ -0,0 +1,128 @@
+"""
+Per-stage timing and counters shared by keepToEnex and onenoteToEnex.
+
+Code marks its stages with `with instrument.stage("json parse"):` and counts
+things with instrument.count("notes"). Stages may nest; each stage records
+its own wall and CPU time, excluding the time spent in stages nested inside
+it. Nothing is recorded until enable() is called, so the marks cost next to
+nothing on a normal run.
+
+Worker processes hand their figures back with collect(), and the parent
+process adds them with merge(). The final figures are written with
+writeReport(), optionally with a cProfile dump of the whole run.
+"""
+import time, json, cProfile, threading
+
+enabled = False
+stages = {}
+counters = {}
+runStart = None
+# stages nest per thread, the totals are shared
+local = threading.local()
+lock = threading.Lock()
+
+def stageStack():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+nullStage = NullStage()
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.childWall = 0.0
+        self.childCpu = 0.0
+        stageStack().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack = stageStack()
+        stack.pop()
+        if stack:
+            stack[-1].childWall += wall
+            stack[-1].childCpu += cpu
+        record(self.name, wall - self.childWall, cpu - self.childCpu)
+        return False
+
+def enable():
+    global enabled, runStart
+    enabled = True
+    runStart = (time.perf_counter(), time.process_time())
+
+def stage(name):
+    return Stage(name) if enabled else nullStage
+
+def record(name, wall, cpu, calls=1):
+    with lock:
+        totals = stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        totals["wall"] += wall
+        totals["cpu"] += cpu
+        totals["calls"] += calls
+
+def count(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+def collect():
+    "Returns and resets the figures recorded so far, for sending back from a worker process"
+    if not enabled: return None
+    figures = {"stages": dict(stages), "counters": dict(counters)}
+    stages.clear()
+    counters.clear()
+    return figures
+
+def merge(figures):
+    "Adds figures returned by collect() in another process"
+    if not figures: return
+    for name, totals in figures["stages"].items():
+        record(name, totals["wall"], totals["cpu"], totals["calls"])
+    for name, n in figures["counters"].items():
+        count(name, n)
+
+def report():
+    wall, cpu = runStart or (time.perf_counter(), time.process_time())
+    return {
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["wall"])),
+        "counters": counters,
+    }
+
+def writeReport(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2)
+
+def run(main, reportPath=None, profilePath=None):
+    """
+    Calls main(), recording stages when reportPath is given and profiling the
+    call when profilePath is given
+    """
+    if reportPath:
+        enable()
+
+    profile = cProfile.Profile() if profilePath else None
+    try:
+        if profile:
+            profile.runcall(main)
+        else:
+            main()
+    finally:
+        if profile:
+            profile.dump_stats(profilePath)
+        if reportPath:
+            writeReport(reportPath)
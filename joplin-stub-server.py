@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+##
+# joplin-stub-server.py
+#
+# Stands in for the Joplin desktop app's REST API (https://joplinapp.org/api/references/rest_api/)
+# so that joplin-update-frontmatter.py can be tried out and timed offline.
+# Serves a generated set of notes and tags from memory, and prints how many requests of
+# each kind it answered when stopped with Ctrl-C. Updates to notes are recorded in the
+# change feed (/events), and --edits changes that many random notes every second.
+# --raw-export writes the same notes and tags as a Joplin RAW export instead of serving them.
+#
+# Usage: joplin-stub-server.py [--notes 1000] [--port 41184] [--token token] [--latency 5] [--edits 0]
+# then:  joplin-update-frontmatter.py token --endpoint http://localhost:41184 [--cursor cursor.json]
+#    or: joplin-stub-server.py [--notes 1000] --raw-export DIR
+# then:  joplin-update-frontmatter.py --export DIR
+#
+
+import os, json, random, time, argparse, threading, hashlib
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+NOTE_FIELDS = ["id", "parent_id", "title"]
+TAG_FIELDS = ["id", "parent_id", "title"]
+EVENT_PAGE_LIMIT = 100
+# type_ of notes, tags and note tags in a RAW export
+ITEM_NOTE = 1
+ITEM_TAG = 5
+ITEM_NOTE_TAG = 6
+
+def export_time(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def write_export_item(export_dir, item_id, title, body, props):
+    "Writes an item file the way Joplin serializes items: title, body and properties, separated by blank lines"
+    parts = [title] if title is not None else []
+    if body:
+        parts.append(body)
+    parts.append("\n".join("%s: %s" % (k, v) for k, v in props))
+    with open(os.path.join(export_dir, item_id + ".md"), "w", encoding="utf-8", newline="") as f:
+        f.write("\n\n".join(parts))
+
+class JoplinStub:
+    "In-memory notes and tags, shared by the request handler threads"
+    def __init__(self, note_count, seed=0):
+        rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.tags = dict(("%032x" % rnd.getrandbits(128), "Tag %d" % i) for i in range(20))
+        self.notes = {}
+        self.note_tags = {}
+        self.events = []
+
+        now = int(time.time() * 1000)
+        for i in range(note_count):
+            note_id = "%032x" % rnd.getrandbits(128)
+            created = now - rnd.randint(0, 10 * 365 * 24 * 3600 * 1000)
+            body = "Body of note %d\n\nwith a second line" % i
+            if rnd.random() < 0.3:
+                body = "---\ncreated: x\n---\n\n" + body
+            self.notes[note_id] = {
+                "id": note_id,
+                "parent_id": "",
+                "title": "Keep Note %d" % i if rnd.random() < 0.2 else "Note number %d" % i,
+                "body": body,
+                "created_time": created,
+                "updated_time": created,
+                "user_created_time": created,
+                "user_updated_time": created,
+            }
+            self.note_tags[note_id] = rnd.sample(list(self.tags), rnd.randint(0, 3))
+
+    def page_of(self, items, query, default_fields):
+        "The page of items asked for by query, with the fields asked for"
+        page = max(int(query.get("page", 1)), 1)
+        limit = min(int(query.get("limit", 10)), 100)
+        fields = query["fields"].split(",") if "fields" in query else default_fields
+        return {
+            "items": [dict((f, i[f]) for f in fields if f in i) for i in items[(page - 1) * limit:page * limit]],
+            "has_more": page * limit < len(items),
+        }
+
+    def list_notes(self, query):
+        order_by = query.get("order_by", "updated_time")
+        reverse = query.get("order_dir", "ASC").upper() == "DESC"
+        with self.lock:
+            notes = sorted(self.notes.values(), key=lambda n: (n[order_by], n["id"]), reverse=reverse)
+        return self.page_of(notes, query, NOTE_FIELDS)
+
+    def list_tags(self, query):
+        tags = [{"id": t, "title": title} for t, title in sorted(self.tags.items())]
+        return self.page_of(tags, query, TAG_FIELDS)
+
+    def get_tag_notes(self, tag_id, query):
+        if tag_id not in self.tags:
+            raise KeyError(tag_id)
+        with self.lock:
+            notes = [n for n in self.notes.values() if tag_id in self.note_tags[n["id"]]]
+        notes.sort(key=lambda n: n["id"])
+        return self.page_of(notes, query, NOTE_FIELDS)
+
+    def get_note(self, note_id, query):
+        fields = query["fields"].split(",") if "fields" in query else NOTE_FIELDS
+        with self.lock:
+            note = self.notes[note_id]
+            return dict((f, note[f]) for f in fields if f in note)
+
+    def get_note_tags(self, note_id):
+        with self.lock:
+            items = [{"id": t, "title": self.tags[t]} for t in self.note_tags[note_id]]
+        return {"items": items, "has_more": False}
+
+    def put_note(self, note_id, changes):
+        with self.lock:
+            note = self.notes[note_id]
+            note.update((k, v) for k, v in changes.items() if k in ("title", "body"))
+            self.touch(note)
+            return note
+
+    def touch(self, note):
+        "Marks a note as updated, the caller holds the lock"
+        note["updated_time"] = int(time.time() * 1000)
+        note["user_updated_time"] = note["updated_time"]
+        self.events.append({
+            "id": len(self.events) + 1,
+            "item_type": 1,
+            "item_id": note["id"],
+            "type": 2,
+            "created_time": note["updated_time"],
+            "source": 1,
+        })
+
+    def edit_notes(self, count, rnd):
+        "Appends a line to count random notes, as if someone was editing them"
+        with self.lock:
+            for note_id in rnd.sample(list(self.notes), min(count, len(self.notes))):
+                note = self.notes[note_id]
+                note["body"] += "\nedited"
+                self.touch(note)
+
+    def write_raw_export(self, export_dir):
+        "Writes the notes, tags and note tags as the item files of a RAW export"
+        os.makedirs(export_dir, exist_ok=True)
+        now = int(time.time() * 1000)
+        for tag_id, title in self.tags.items():
+            write_export_item(export_dir, tag_id, title, None, [
+                ("id", tag_id), ("created_time", export_time(now)), ("updated_time", export_time(now)),
+                ("user_created_time", export_time(now)), ("user_updated_time", export_time(now)),
+                ("encryption_cipher_text", ""), ("encryption_applied", 0), ("is_shared", 0), ("parent_id", ""),
+                ("type_", ITEM_TAG)])
+        for note in self.notes.values():
+            write_export_item(export_dir, note["id"], note["title"], note["body"], [
+                ("id", note["id"]), ("parent_id", note["parent_id"]),
+                ("created_time", export_time(note["created_time"])), ("updated_time", export_time(note["updated_time"])),
+                ("is_conflict", 0), ("latitude", "0.00000000"), ("longitude", "0.00000000"), ("altitude", "0.0000"),
+                ("author", ""), ("source_url", ""), ("is_todo", 0), ("todo_due", 0), ("todo_completed", 0),
+                ("source", "joplin-desktop"), ("source_application", "net.cozic.joplin-desktop"),
+                ("application_data", ""), ("order", 0),
+                ("user_created_time", export_time(note["user_created_time"])),
+                ("user_updated_time", export_time(note["user_updated_time"])),
+                ("encryption_cipher_text", ""), ("encryption_applied", 0), ("markup_language", 1), ("is_shared", 0),
+                ("share_id", ""), ("conflict_original_id", ""), ("master_key_id", ""), ("user_data", ""),
+                ("deleted_time", 0), ("type_", ITEM_NOTE)])
+            for tag_id in self.note_tags[note["id"]]:
+                note_tag_id = hashlib.md5((note["id"] + tag_id).encode("ascii")).hexdigest()
+                write_export_item(export_dir, note_tag_id, None, None, [
+                    ("id", note_tag_id), ("note_id", note["id"]), ("tag_id", tag_id),
+                    ("created_time", export_time(now)), ("updated_time", export_time(now)),
+                    ("user_created_time", export_time(now)), ("user_updated_time", export_time(now)),
+                    ("encryption_cipher_text", ""), ("encryption_applied", 0), ("is_shared", 0),
+                    ("type_", ITEM_NOTE_TAG)])
+
+    def list_events(self, query):
+        # without a cursor only the current position is returned
+        with self.lock:
+            last = len(self.events)
+            if "cursor" not in query:
+                return {"items": [], "cursor": str(last), "has_more": False}
+            start = int(query["cursor"])
+            items = self.events[start:start + EVENT_PAGE_LIMIT]
+        cursor = start + len(items)
+        return {"items": items, "cursor": str(cursor), "has_more": cursor < last}
+
+def make_handler(stub, token, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def route(self, method):
+            url = urlparse(self.path)
+            query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            parts = [p for p in url.path.split("/") if p]
+            length = int(self.headers.get("Content-Length") or 0)
+            data = self.rfile.read(length) if length else b""
+
+            if latency:
+                time.sleep(latency / 1000.0)
+            if query.get("token") != token:
+                return self.reply(403, {"error": "Invalid token"})
+
+            try:
+                if method == "GET" and parts == ["notes"]:
+                    kind, result = "list notes", stub.list_notes(query)
+                elif method == "GET" and len(parts) == 2 and parts[0] == "notes":
+                    kind, result = "get note", stub.get_note(parts[1], query)
+                elif method == "GET" and len(parts) == 3 and parts[0] == "notes" and parts[2] == "tags":
+                    kind, result = "get tags", stub.get_note_tags(parts[1])
+                elif method == "GET" and parts == ["tags"]:
+                    kind, result = "list tags", stub.list_tags(query)
+                elif method == "GET" and len(parts) == 3 and parts[0] == "tags" and parts[2] == "notes":
+                    kind, result = "get tag notes", stub.get_tag_notes(parts[1], query)
+                elif method == "GET" and parts == ["events"]:
+                    kind, result = "events", stub.list_events(query)
+                elif method == "PUT" and len(parts) == 2 and parts[0] == "notes":
+                    kind, result = "put note", stub.put_note(parts[1], json.loads(data or b"{}"))
+                else:
+                    return self.reply(404, {"error": "Not found: " + url.path})
+            except KeyError as e:
+                return self.reply(404, {"error": "Not found: %s" % e})
+
+            with stub.lock:
+                stub.requests[kind] += 1
+            self.reply(200, result)
+
+        def do_GET(self):
+            self.route("GET")
+
+        def do_PUT(self):
+            self.route("PUT")
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", default=1000, type=int)
+    parser.add_argument("--port", default=41184, type=int)
+    parser.add_argument("--token", default="token")
+    parser.add_argument("--latency", default=0, type=float, help="milliseconds added to every request")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--edits", default=0, type=int, help="notes edited every second")
+    parser.add_argument("--raw-export", default=None, help="write the notes as a RAW export to this directory instead of serving them")
+    args = parser.parse_args()
+
+    stub = JoplinStub(args.notes, args.seed)
+    if args.raw_export:
+        stub.write_raw_export(args.raw_export)
+        print("wrote %i notes to %s" % (args.notes, args.raw_export))
+        return
+    server = ThreadingHTTPServer(("localhost", args.port), make_handler(stub, args.token, args.latency))
+    print("serving %i notes on http://localhost:%i" % (args.notes, args.port))
+
+    if args.edits:
+        def edit():
+            rnd = random.Random(args.seed)
+            while True:
+                time.sleep(1)
+                stub.edit_notes(args.edits, rnd)
+        threading.Thread(target=edit, daemon=True).start()
+
+    start = time.time()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+    print("requests in %.1fs:" % (time.time() - start), dict(stub.requests))
+
+if __name__ == "__main__":
+    main()
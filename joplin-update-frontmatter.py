@@ -15,6 +15,11 @@
 #   curl "http://localhost:41184/notes/NOTEID/?fields=body,created_time,user_created_time,updated_time,user_updated_time&token=YOURBIGTOKEN"
 # Get a specific notes tags:
 #   curl "http://localhost:41184/notes/NOTEID/tags?token=YOURBIGTOKEN"
+# Get the tags, and the notes of a tag:
+#   curl "http://localhost:41184/tags?fields=id,title&token=YOURBIGTOKEN"
+#   curl "http://localhost:41184/tags/TAGID/notes?fields=id&token=YOURBIGTOKEN"
+# Get the notes changed since a cursor returned by an earlier call (no cursor returns the latest one):
+#   curl "http://localhost:41184/events?cursor=CURSOR&token=YOURBIGTOKEN"
 
 # Program creates YAML FrontMatter in the following format:
 # ---
@@ -23,80 +28,418 @@
 # tags: [Note, Multi-Word-Tag, lower-case-tag]
 # ---
 
-import sys, re, json, random, requests
-from datetime import datetime, timezone
+# Usage: joplin-update-frontmatter.py TOKEN [--jobs 4] [--endpoint http://localhost:41184] [--cursor cursor.json]
+#    or: joplin-update-frontmatter.py --export DIR [--jobs 4]
+# --jobs sets how many notes are processed at once over a shared pool of connections.
+# The tags of all notes are read up front, with a request per tag rather than one per note.
+# --cursor keeps the position in Joplin's change feed (/events) in a file: the first run visits every note,
+# later runs only the notes created or updated since the run before. Joplin keeps 90 days of changes,
+# delete the file to visit every note again. The file also lists the notes the run updated itself, with
+# when, so that the next run doesn't visit them again for those updates.
+# --export updates the notes of a RAW export directory, or of an unpacked .jex archive, in place, without
+# the Joplin app: the tags are read in one pass over the item files, then the notes are rewritten by --jobs
+# worker processes. Import the directory back with File > Import > RAW (or JEX, after packing it again with tar).
+# joplin-stub-server.py stands in for the Joplin API to try this out offline, --raw-export writes its notes as an export
 
-TOKEN = sys.argv[1]
+import os, re, json, glob, time, random, requests, argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone, timedelta
+
+TOKEN = None
 NOTES_ENDPOINT = "http://localhost:41184/notes"
+EVENTS_ENDPOINT = "http://localhost:41184/events"
+TAGS_ENDPOINT = "http://localhost:41184/tags"
+# fetched with the list of notes, so that no note needs a request of its own
+NOTE_FIELDS = "id,title,body,user_created_time,user_updated_time"
+# item_type of notes and type of deletions in /events
+EVENT_NOTE = 1
+EVENT_DELETED = 3
+# type_ of the items in a RAW export
+ITEM_NOTE = 1
+ITEM_TAG = 5
+ITEM_NOTE_TAG = 6
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# item files handed to a worker process at a time
+EXPORT_CHUNK_SIZE = 256
+# read from the end of each item file to find its type_, tags and note tags fit in it whole
+SCAN_BYTES = 4096
+ITEM_TYPE_RE = re.compile(rb"(?:^|\n)type_: *(\d+)\s*$")
 TITLE_CHARS = 55
 TITLE_LEEWAY = 10
+PAGE_LIMIT = 100
+
+session = requests.Session()
+# the tags of each note by its id, in the worker processes of --export
+export_note_tags = {}
+# the tags of each note by its id, from load_note_tags, None to ask for each note's tags
+api_note_tags = None
 
-def get_note_metadata(noteid):
-    return requests.get('{}/{}/?fields=body,title,user_created_time,user_updated_time&token={}'.format(NOTES_ENDPOINT, noteid, TOKEN))
+def get_note(noteid):
+    return session.get('{}/{}?fields={}&token={}'.format(NOTES_ENDPOINT, noteid, NOTE_FIELDS, TOKEN))
+
+def tag_name(title):
+    return re.sub(r'[^a-zA-Z_-]', '', title.replace(" ", "-"))
 
 def get_note_tags(noteid):
-    note_tags = []
-    res = requests.get('{}/{}/tags?token={}'.format(NOTES_ENDPOINT, noteid, TOKEN)).json()["items"]
-    return [re.sub(r'[^a-zA-Z_-]', '', tag.get("title").replace(" ", "-")) for tag in res]
+    if api_note_tags is not None:
+        return api_note_tags.get(noteid, [])
+    res = session.get('{}/{}/tags?token={}'.format(NOTES_ENDPOINT, noteid, TOKEN)).json()["items"]
+    return sorted(tag_name(tag.get("title")) for tag in res)
+
+def get_pages(url):
+    "Yields the items of every page of a listing, url has a query string already"
+    page = 1
+    while True:
+        res = session.get('{}&page={}&limit={}'.format(url, page, PAGE_LIMIT)).json()
+        yield from res["items"]
+        if not res["has_more"]:
+            break
+        page += 1
 
-def get_note_ids(page=0):
-    res = requests.get('{}?order_by=user_updated_time&order_dir=DESC&page={}&token={}'.format(NOTES_ENDPOINT, page, TOKEN))
+def get_tag_note_ids(tagid):
+    return [note["id"] for note in get_pages('{}/{}/notes?fields=id&token={}'.format(TAGS_ENDPOINT, tagid, TOKEN))]
+
+def load_note_tags(note_count=None, jobs=1):
+    """
+    Reads the tags of every note, a request per tag (and page) instead of
+    one per note. When only note_count notes are going to be visited and
+    that is fewer than there are tags, each of them is asked for its tags
+    instead
+    """
+    global api_note_tags
+    tags = list(get_pages('{}?fields=id,title&token={}'.format(TAGS_ENDPOINT, TOKEN)))
+    if note_count is not None and note_count < len(tags):
+        api_note_tags = None
+        return
+    note_tags = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for tag, noteids in zip(tags, executor.map(get_tag_note_ids, [tag["id"] for tag in tags])):
+            for noteid in noteids:
+                note_tags.setdefault(noteid, []).append(tag_name(tag.get("title")))
+    for names in note_tags.values():
+        names.sort()
+    api_note_tags = note_tags
+
+def get_notes(page=1):
+    res = session.get('{}?order_by=user_updated_time&order_dir=DESC&fields={}&page={}&limit={}&token={}'.format(NOTES_ENDPOINT, NOTE_FIELDS, page, PAGE_LIMIT, TOKEN))
     return res
 
+def get_events(cursor=None):
+    url = '{}?token={}'.format(EVENTS_ENDPOINT, TOKEN)
+    if cursor is not None:
+        url += '&cursor={}'.format(cursor)
+    return session.get(url)
+
+def get_changed_note_ids(cursor, own_puts={}):
+    """
+    Returns the ids of the notes created or updated since cursor and still
+    there, and the cursor to continue from next time. own_puts has the time
+    of the last update the previous run made to a note by its id, changes
+    up to then were seen by that run
+    """
+    changed = {}
+    while True:
+        res = get_events(cursor).json()
+        for event in res["items"]:
+            if event["item_type"] != EVENT_NOTE:
+                continue
+            if event["created_time"] <= own_puts.get(event["item_id"], -1):
+                continue
+            changed.pop(event["item_id"], None)
+            if event["type"] != EVENT_DELETED:
+                changed[event["item_id"]] = True
+        cursor = res["cursor"]
+        if not res["has_more"]:
+            break
+    return list(changed), cursor
+
+def read_cursor(path):
+    "Returns the cursor saved in path and the updates made by the run that saved it, None and {} without one"
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None, {}
+    return saved["cursor"], saved.get("puts", {})
+
+def write_cursor(path, cursor, puts):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"cursor": cursor, "puts": puts}, f)
+    os.replace(path + ".tmp", path)
+
 def fuzzy_title_length(title):
     if len(title) > TITLE_CHARS:
         ind = title.find(" ", TITLE_CHARS - TITLE_LEEWAY)
         return title[0: ind].strip()
     return title.strip()
 
-def process_notes(page=0):
-    res = get_note_ids(page)
-    for note in res.json()["items"]:
-        note_metadata = get_note_metadata(note["id"]).json()
-        body = note_metadata["body"]
-        title = note_metadata["title"].strip()
+def add_frontmatter(note, get_tags):
+    """
+    Returns the title and body of a note given its NOTE_FIELDS: the title
+    shortened and cleaned up, and frontmatter put in front of the body
+    unless it has some already. get_tags(noteid) returns the note's tags
+    """
+    body = note["body"]
+    title = note["title"].strip()
 
-        created = datetime.fromtimestamp(round(note_metadata["user_created_time"] / 1000), timezone.utc).astimezone()
-        updated = datetime.fromtimestamp(round(note_metadata["user_updated_time"] / 1000), timezone.utc).astimezone()
+    created = datetime.fromtimestamp(round(note["user_created_time"] / 1000), timezone.utc).astimezone()
+    updated = datetime.fromtimestamp(round(note["user_updated_time"] / 1000), timezone.utc).astimezone()
 
-        print("original title: %s " % title)
-        if title.startswith("Keep Note"):
-            title = body.replace('\n', ' ')
+    if title.startswith("Keep Note"):
+        title = body.replace('\n', ' ')
 
-        title = re.sub(r'[^a-zA-Z0-9\s\.,\&\)\(_-]', '', fuzzy_title_length(title))
+    title = re.sub(r'[^a-zA-Z0-9\s\.,\&\)\(_-]', '', fuzzy_title_length(title))
 
-        front_matter = ""
-        if body.strip().startswith("---"):
-            print("Note <%s> already has frontmatter: %s" % (title, body))
-        else:
-            front_matter = f"""---
+    front_matter = ""
+    if not body.strip().startswith("---"):
+        front_matter = f"""---
 created: {created}
 updated: {updated}
 """
-            tags = get_note_tags(note["id"])
-            if tags:
-                front_matter += "tags: [" + ", ".join(tags) + "]\n"
-            front_matter += "---\n\n"
+        tags = get_tags(note["id"])
+        if tags:
+            front_matter += "tags: [" + ", ".join(tags) + "]\n"
+        front_matter += "---\n\n"
+
+        # front_matter += "# " + title + "\n"
+
+    return title, front_matter + body
+
+def process_note(note):
+    """
+    Adds frontmatter to a note, given its NOTE_FIELDS. Returns the time of
+    the update in milliseconds, None when the note was left as it was
+    """
+    title, body = add_frontmatter(note, get_note_tags)
+    lines = ["original title: %s " % note["title"].strip()]
+    if body == note["body"]:
+        lines.append("Note <%s> already has frontmatter: %s" % (title, body))
+    lines += ["id: %s" % note["id"], "filename %s" % title, "body %s" % body]
+
+    put_time = None
+    if body and title and (body != note["body"] or title != note["title"]):
+        # Only update if the new body is not empty (just a safeguard)
+        res = session.put(
+            '{}/{}?token={}'.format(NOTES_ENDPOINT, note["id"], TOKEN),
+            data='{{ "body" : {}, "title": {} }}'.format(json.dumps(body), json.dumps(title))
+        )
+        # Joplin records the change in /events once the note is saved, by the time it answers
+        put_time = max(int(time.time() * 1000), res.json().get("updated_time", 0))
+    else:
+        lines.append("skipping put request: %s" % title)
+    # one write per note, so that the notes of other threads don't end up in the middle
+    print("\n".join(lines) + "\n", end="")
+    return put_time
+
+def process_notes(jobs=1):
+    """
+    Walks the pages of notes, processing up to jobs notes of a page at once.
+    Returns the time of each update made by the note's id
+    """
+    load_note_tags(jobs=jobs)
+    puts = {}
+    page = 1
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            res = get_notes(page).json()
+            # waits for the page and raises any error from process_note
+            for note, put_time in zip(res["items"], executor.map(process_note, res["items"])):
+                if put_time is not None:
+                    puts[note["id"]] = put_time
+            if not res["has_more"]:
+                break
+            page += 1
+    return puts
+
+def process_changed_note(noteid):
+    res = get_note(noteid)
+    if res.status_code == 404:
+        return None  # deleted since
+    return process_note(res.json())
+
+def process_changed_notes(cursor_path, jobs=1):
+    """
+    Processes the notes changed since the cursor saved in cursor_path, or
+    every note when there is none yet, then saves the cursor for next time.
+    The cursor is taken before the notes are visited, so notes changed
+    during the run are visited again by the next one, except for the
+    changes made by the run itself: their times are saved with the cursor
+    """
+    cursor, own_puts = read_cursor(cursor_path)
+    if cursor is None:
+        next_cursor = get_events().json()["cursor"]
+        puts = process_notes(jobs)
+    else:
+        noteids, next_cursor = get_changed_note_ids(cursor, own_puts)
+        print("%i notes changed since the last run" % len(noteids))
+        load_note_tags(len(noteids), jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            puts = dict((noteid, put_time) for noteid, put_time in zip(noteids, executor.map(process_changed_note, noteids))
+                        if put_time is not None)
+    write_cursor(cursor_path, next_cursor, puts)
+
+def parse_item(content):
+    """
+    Parses an item file of a RAW export: the title, a blank line and the
+    body, then after another blank line a "key: value" line per property,
+    ending with type_. Returns the title, the body, the properties as a dict
+    and their lines as they are
+    """
+    lines = content.split("\n")
+    start = len(lines)
+    while start > 0 and lines[start - 1].strip():
+        start -= 1
+    prop_lines = lines[start:]
+    props = {}
+    for line in prop_lines:
+        key, _, value = line.partition(":")
+        props[key.strip()] = value.strip()
+    text = lines[:max(start - 1, 0)]
+    return (text[0] if text else ""), "\n".join(text[2:]), props, prop_lines
+
+def read_item(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return parse_item(f.read())
+
+def write_item(path, title, body, prop_lines):
+    "Writes an item file in the form read_item reads, replacing the file only once it is complete"
+    # a line break would end the title early
+    parts = [title.replace("\r", " ").replace("\n", " ")]
+    if body:
+        parts.append(body)
+    parts.append("\n".join(prop_lines))
+    with open(path + ".tmp", "w", encoding="utf-8", newline="") as f:
+        f.write("\n\n".join(parts))
+    os.replace(path + ".tmp", path)
+
+def export_time(value):
+    "Milliseconds since the epoch of a time in a RAW export, 0 when there is none"
+    if not value:
+        return 0
+    # whole milliseconds, as the API gives them, a float could round the other way
+    return (datetime.fromisoformat(value.rstrip("Z")).replace(tzinfo=timezone.utc) - EPOCH) // timedelta(milliseconds=1)
+
+def scan_item(path):
+    """
+    Returns the type_ of an item file, with the id and name of a tag or the
+    note and tag ids of a note tag. Only the end of a note is read, the
+    type_ is its last property
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - SCAN_BYTES, 0))
+        tail = f.read()
+    match = ITEM_TYPE_RE.search(tail)
+    if match is not None and int(match.group(1)) not in (ITEM_TAG, ITEM_NOTE_TAG):
+        return int(match.group(1)), None, None
+
+    title, _, props, _ = read_item(path) if size > SCAN_BYTES else parse_item(tail.decode("utf-8"))
+    item_type = int(props.get("type_") or 0)
+    if item_type == ITEM_TAG:
+        return item_type, props["id"], tag_name(title)
+    if item_type == ITEM_NOTE_TAG:
+        return item_type, props["note_id"], props["tag_id"]
+    return item_type, None, None
+
+def init_export_worker(note_tags):
+    global export_note_tags
+    export_note_tags = note_tags
+
+def map_export(function, paths, jobs, note_tags=None):
+    "Calls function on each path, in jobs worker processes that are given note_tags"
+    if jobs <= 1:
+        init_export_worker(note_tags)
+        return list(map(function, paths))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_export_worker, initargs=(note_tags,)) as executor:
+        return list(executor.map(function, paths, chunksize=EXPORT_CHUNK_SIZE))
+
+def scan_export(export_dir, jobs=1):
+    """
+    Goes through the item files of a RAW export once. Returns the paths of
+    the notes and the tags of each note by its id, only tags and note tags
+    are read in full
+    """
+    paths = glob.glob(os.path.join(export_dir, "*.md"))
+    note_paths = []
+    tag_names = {}
+    note_tag_ids = []
+    for path, (item_type, first, second) in zip(paths, map_export(scan_item, paths, jobs)):
+        if item_type == ITEM_NOTE:
+            note_paths.append(path)
+        elif item_type == ITEM_TAG:
+            tag_names[first] = second
+        elif item_type == ITEM_NOTE_TAG:
+            note_tag_ids.append((first, second))
+
+    note_tags = {}
+    for noteid, tagid in note_tag_ids:
+        # a note tag can outlive its tag
+        if tagid in tag_names:
+            note_tags.setdefault(noteid, []).append(tag_names[tagid])
+    for tags in note_tags.values():
+        tags.sort()
+    return note_paths, note_tags
+
+def process_export_note(path):
+    "Adds frontmatter to the note in an item file, returns whether the file was changed"
+    title, body, props, prop_lines = read_item(path)
+    # encrypted notes and notes in the trash are left as they are, like the API leaves them out
+    if props.get("encryption_applied") == "1" or props.get("deleted_time", "0") not in ("", "0"):
+        return False
+    note = {
+        "id": props["id"],
+        "title": title,
+        "body": body,
+        "user_created_time": export_time(props.get("user_created_time")),
+        "user_updated_time": export_time(props.get("user_updated_time")),
+    }
+    new_title, new_body = add_frontmatter(note, lambda noteid: export_note_tags.get(noteid, []))
+    if new_body and new_title and (new_body != body or new_title != title):
+        write_item(path, new_title, new_body, prop_lines)
+        return True
+    return False
 
-            # front_matter += "# " + title + "\n"
+def process_export(export_dir, jobs=1):
+    """
+    Adds frontmatter to the notes of a RAW export directory or an unpacked
+    .jex archive, in place. Notes are rewritten by jobs worker processes,
+    the Python work for each note outweighs reading and writing it
+    """
+    note_paths, note_tags = scan_export(export_dir, jobs)
+    print("%i notes, %i of them tagged" % (len(note_paths), len(note_tags)))
+    updated = sum(map_export(process_export_note, note_paths, jobs, note_tags))
+    print("updated %i notes" % updated)
 
-        body = front_matter + body
+def main():
+    global TOKEN, NOTES_ENDPOINT, EVENTS_ENDPOINT, TAGS_ENDPOINT
+    parser = argparse.ArgumentParser()
+    parser.add_argument("token", nargs="?", help="the token of Joplin's web clipper service, not needed with --export")
+    parser.add_argument("--jobs", default=4, type=int)
+    parser.add_argument("--endpoint", default="http://localhost:41184")
+    parser.add_argument("--cursor", default=None, help="file keeping the position in the change feed, to only visit changed notes")
+    parser.add_argument("--export", default=None, help="update a RAW export directory or an unpacked .jex archive instead of going through the API")
+    args = parser.parse_args()
 
-        print("id:", note["id"])
-        print("filename", title)
-        print("body", body)
+    if args.export:
+        if args.cursor:
+            parser.error("--cursor follows the API's change feed, it can't be used with --export")
+        process_export(args.export, args.jobs)
+        return
+    if args.token is None:
+        parser.error("the token is needed, unless --export is given")
 
-        if body and title and (body != note_metadata["body"] or title != note_metadata["title"]):
-            # Only update if the new body is not empty (just a safeguard)
-            requests.put(
-                '{}/{}?token={}'.format(NOTES_ENDPOINT, note["id"], TOKEN),
-                data='{{ "body" : {}, "title": {} }}'.format(json.dumps(body), json.dumps(title))
-            )
-        else:
-            print("skipping put request: %s" % title)
+    TOKEN = args.token
+    NOTES_ENDPOINT = args.endpoint.rstrip("/") + "/notes"
+    EVENTS_ENDPOINT = args.endpoint.rstrip("/") + "/events"
+    TAGS_ENDPOINT = args.endpoint.rstrip("/") + "/tags"
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
-    if res.json()["has_more"]:
-        process_notes(page+1)
+    if args.cursor:
+        process_changed_notes(args.cursor, args.jobs)
+    else:
+        process_notes(args.jobs)
 
 if __name__ == "__main__":
-    process_notes()
+    main()
@@ -1,102 +1,874 @@
 from __future__ import print_function
-import sys, glob, os, shutil, zipfile, time, codecs, re, argparse, json, base64, hashlib
+import sys, glob, os, shutil, zipfile, time, re, argparse, json, base64, hashlib, io, posixpath, threading, queue, collections
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from zipfile import ZipFile
+from functools import partial
 from datetime import datetime, timezone
-from PIL import Image
-from mako.template import Template
+import enexTemplates, imageSize, instrument, attachmentCache, outputSink, noteDigests
+try:
+    import orjson
+except ImportError:
+    orjson = None
 # from dateutil.parser import parse
 
 ## TODO: account for different colored notes with tags
 
-indexErrorCount = 0
-fileCount = 0
+workerOptions = None
+workerSource = None
+workerKnownHashes = {}
 jsonExt = re.compile(r"\.json$", re.I)
+# json files looked at in each folder of an export without a Keep folder, see findKeepDir
+keepProbeCount = 5
+# attachments are read, hashed and base64 encoded this many bytes at a time,
+# a multiple of 3 so the encoded chunks concatenate without padding
+dataChunkSize = 3 * 64 * 1024
+# what textToEnml replaces, in order: & goes first so the entities added
+# after it are left alone
+enmlText = [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ("\n", "<br/>"), ("\r", "<br/>")]
+# (width, height) of attachments by MD5, for one conversion
+imageSizes = {}
+# MD5s and encodings of attachments already read, see attachmentCache.py.
+# The encodings are kept from one conversion to the next, see getCache
+cache = None
 
 class InvalidEncoding(Exception):
     def __init__(self, inner):
         Exception.__init__(self)
         self.inner = str(inner)
 
+class ConversionError(Exception):
+    "A conversion that can't go ahead, such as an unreadable zip"
+
+class KeepOptions:
+    """
+    Options of a conversion, see convertKeep. The defaults are those of the
+    command line, KeepOptions(jobs=4) changes one
+    """
+    author = "Anonymous"
+    defaultTitle = ""
+    includeTrashed = False
+    addLabel = None
+    extract = False
+    jobs = 1
+    notesPerFile = None
+    maxFileBytes = 0
+    incremental = False
+    cacheMB = 64
+    pipeline = False
+    pipelineMB = 64
+    compress = None
+    compressLevel = 6
+    writeBufferKB = 64
+    dedup = False
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not hasattr(KeepOptions, name) or name.startswith("_"):
+                raise TypeError("unknown option: " + name)
+            setattr(self, name, value)
+
+    @classmethod
+    def fromArgs(cls, args):
+        "The options among the parsed command line arguments"
+        return cls(**dict((name, value) for name, value in vars(args).items() if hasattr(cls, name)))
+
 def msg(s):
     print(s, file=sys.stderr)
     sys.stderr.flush()
 
-def jsonFileToEnex(inputPath, outputDir, inputDir):
-    global fileCount, indexErrorCount
-    basename = os.path.basename(inputPath).replace(".html", ".enex")
-    outfname = os.path.join(outputDir, str(fileCount) + ".enex")
+class KeepDirSource:
+    "Reads Keep json files and their attachments from an extracted Takeout directory"
+    def __init__(self, inputDir):
+        self.inputDir = inputDir
+
+    def jsonPaths(self):
+        return sorted(glob.glob(os.path.join(self.inputDir, "*.json")))
+
+    def attachmentPath(self, filePath):
+        return os.path.join(self.inputDir, filePath)
+
+    def open(self, path):
+        return open(path, "rb")
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    def cacheKey(self, path):
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime_ns)
+
+    def fingerprint(self, path):
+        "MD5 of the file, extracted files don't keep their modification times"
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in readChunks(f):
+                with instrument.stage("hashing"):
+                    md5.update(chunk)
+        return md5.hexdigest()
+
+def openVolumes(zipFileNames):
+    """
+    Opens the volumes of a Takeout export, reading their central directories
+    in parallel. Returns the ZipFiles and an index of the volume number of
+    each entry, an entry in more than one volume is read from the first
+    """
+    with ThreadPoolExecutor(min(len(zipFileNames), 8)) as executor:
+        futures = [executor.submit(ZipFile, name) for name in zipFileNames]
+    try:
+        zipFiles = [future.result() for future in futures]
+    except Exception:
+        # don't leak the handles of the volumes that did open
+        for future in futures:
+            if future.exception() is None:
+                future.result().close()
+        raise
+    index = {}
+    for volume, zipFile in enumerate(zipFiles):
+        for name in zipFile.namelist():
+            index.setdefault(name, volume)
+    return zipFiles, index
+
+class KeepZipSource:
+    """
+    Reads Keep json files and their attachments straight out of the Takeout
+    zips, without extracting them to disk. A large export is split over
+    several zips and a note's attachments can be in another volume than its
+    json file, each entry is read from the volume the index maps it to
+    """
+    def __init__(self, zipFileNames, jsonDir, index, zipFiles=None):
+        self.zipFileNames = zipFileNames
+        self.jsonDir = jsonDir
+        # entry name -> volume number, see openVolumes
+        self.index = index
+        self.zipFiles = dict(enumerate(zipFiles or []))
+        self.zipPid = os.getpid()
+
+    def __getstate__(self):
+        # worker processes open their own handles on the volumes
+        return dict(self.__dict__, zipFiles={}, zipPid=None)
+
+    def getZipFile(self, path):
+        if path not in self.index:
+            raise KeyError("There is no item named %r in the archive" % path)
+        # a handle inherited through fork would share its file offset with the parent
+        if self.zipPid != os.getpid():
+            self.zipFiles = {}
+            self.zipPid = os.getpid()
+        volume = self.index[path]
+        if volume not in self.zipFiles:
+            self.zipFiles[volume] = ZipFile(self.zipFileNames[volume])
+        return self.zipFiles[volume]
+
+    def getinfo(self, path):
+        return self.getZipFile(path).getinfo(path)
+
+    def jsonPaths(self):
+        return sorted(n for n in self.index
+                      if posixpath.dirname(n) == self.jsonDir and jsonExt.search(n))
+
+    def attachmentPath(self, filePath):
+        return posixpath.join(self.jsonDir, filePath)
+
+    def open(self, path):
+        return self.getZipFile(path).open(path)
+
+    def size(self, path):
+        return self.getinfo(path).file_size
+
+    def cacheKey(self, path):
+        # the CRC tells apart same named entries of another export, the cache outlives a conversion
+        info = self.getinfo(path)
+        return (path, info.file_size, info.date_time, info.CRC)
+
+    def fingerprint(self, path):
+        "CRC and size of the entry, read from the zip's central directory"
+        info = self.getinfo(path)
+        return "%08x:%d" % (info.CRC, info.file_size)
+
+    def close(self):
+        for zipFile in self.zipFiles.values():
+            zipFile.close()
+        self.zipFiles = {}
+
+class PreloadedSource:
+    "Serves the files read ahead by the --pipeline reader from memory, and the rest from source"
+    def __init__(self, source, files):
+        self.source = source
+        self.files = files
+
+    def attachmentPath(self, filePath):
+        return self.source.attachmentPath(filePath)
+
+    def open(self, path):
+        if path in self.files:
+            return io.BytesIO(self.files[path])
+        return self.source.open(path)
+
+    def size(self, path):
+        return self.source.size(path)
+
+    def cacheKey(self, path):
+        return self.source.cacheKey(path)
+
+    def fingerprint(self, path):
+        return self.source.fingerprint(path)
+
+class NoteResult:
+    """
+    Outcome of converting a single json file. The counters are set when the
+    note is written and summed up by jsonDirToEnex. digest is the note's
+    noteDigests digest, with --dedup
+    """
+    def __init__(self, inputPath, note=None, error=None, noteHash=None, unchanged=False, digest=None):
+        self.inputPath = inputPath
+        # stage timings recorded by a worker process, see instrument.collect
+        self.stats = None
+        self.name = os.path.basename(inputPath)
+        self.note = note
+        self.error = error
+        self.noteHash = noteHash
+        self.unchanged = unchanged
+        self.digest = digest
+        self.fileCount = 0
+        self.indexErrorCount = 0
+        self.unchangedCount = 0
+        self.duplicateCount = 0
+
+def convertJsonFile(inputPath, source, options, knownHashes={}, parsed=None):
+    """
+    Parses a json file and reads its attachments, can run in a worker process.
+    Notes whose hash matches knownHashes are left unconverted. parsed is the
+    (data, note) pair from readJsonFile when the file was read already
+    """
+    try:
+        data, keepNote = parsed or readJsonFile(inputPath, source)
+        noteHash = hashJsonFile(data, keepNote, source)
+        if knownHashes.get(os.path.basename(inputPath)) == noteHash:
+            return NoteResult(inputPath, noteHash=noteHash, unchanged=True)
+        note = extractNoteFromJsonFile(inputPath, source, keepNote, options)
+        digest = note.digest() if options.dedup else None
+        return NoteResult(inputPath, note=note, noteHash=noteHash, digest=digest)
+    except Exception as e:
+        return NoteResult(inputPath, error=e)
+
+def initWorker(options, source, knownHashes, report):
+    global workerOptions, workerSource, workerKnownHashes, cache
+    workerOptions = options
+    workerSource = source
+    workerKnownHashes = knownHashes
+    # workers only look up attachment files, encodings are cached by the writer
+    cache = attachmentCache.AttachmentCache(0)
+    if report:
+        instrument.enable()
+
+def convertJsonFileInWorker(inputPath):
+    result = convertJsonFile(inputPath, workerSource, workerOptions, workerKnownHashes)
+    result.stats = instrument.collect()
+    return result
 
-    with codecs.open(inputPath, "r", "utf-8") as inf, codecs.open(outfname, "w", args.encoding) as outf:
+def convertInPool(paths, initargs, jobs, window):
+    """
+    Yields a NoteResult per path taken from the iterator paths, in order,
+    from a pool of jobs worker processes with up to window notes in
+    progress. A worker that dies, killed for running out of memory say,
+    breaks the pool: returns the notes in progress then, in order, the rest
+    are left in paths
+    """
+    pending = collections.deque()
+    executor = ProcessPoolExecutor(jobs, initializer=initWorker, initargs=initargs)
+    try:
+        while True:
+            while len(pending) < window:
+                path = next(paths, None)
+                if path is None: break
+                try:
+                    future = executor.submit(convertJsonFileInWorker, path)
+                except BrokenProcessPool as e:
+                    future = Future()
+                    future.set_exception(e)
+                pending.append((path, future))
+            if not pending: return []
+
+            path, future = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                return [path] + [p for p, _ in pending]
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def convertJsonFiles(paths, source, knownHashes, options):
+    "Yields a NoteResult per path, in order, using a process pool when options.jobs > 1"
+    if options.jobs <= 1:
+        for path in paths:
+            yield convertJsonFile(path, source, options, knownHashes)
+        return
+
+    initargs = (options, source, knownHashes, instrument.enabled)
+    paths = iter(paths)
+    while True:
+        broken = yield from convertInPool(paths, initargs, options.jobs, 4 * options.jobs)
+        if not broken: return
+        for path in broken:
+            # again one note to a pool, so that only the note that kills its worker fails
+            if len(broken) == 1 or (yield from convertInPool(iter([path]), initargs, 1, 1)):
+                yield NoteResult(path, error=ConversionError("the worker process converting it died"))
+
+class ByteBudget:
+    """
+    Bytes held by notes in the --pipeline, take() blocks while the pipeline
+    holds more than limit. A note larger than the whole budget goes through
+    once nothing else is held
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.taken = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def take(self, n):
+        with self.condition:
+            while self.taken and self.taken + n > self.limit and not self.closed:
+                self.condition.wait()
+            self.taken += n
+
+    def give(self, n):
+        with self.condition:
+            self.taken -= n
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def encodeJsonFile(inputPath, source, options, knownHashes, parsed, files):
+    """
+    The encoding stage of --pipeline: converts a note read ahead by
+    readAhead and base64 encodes the attachments read with it
+    """
+    result = convertJsonFile(inputPath, PreloadedSource(source, files), options, knownHashes, parsed)
+    if result.note is not None:
+        for attachment in result.note.attachments:
+            if attachment["path"] in files:
+                with instrument.stage("base64 encode"):
+                    attachment["data"] = base64.b64encode(files[attachment["path"]]).decode("ascii")
+    return result
+
+def encodeJsonFileInWorker(inputPath, parsed, files):
+    result = encodeJsonFile(inputPath, workerSource, workerOptions, workerKnownHashes, parsed, files)
+    result.stats = instrument.collect()
+    return result
+
+class WorkerPool:
+    """
+    The --jobs worker processes of the --pipeline. A worker that dies breaks
+    the pool for every note in it: restart() starts another pool for the
+    notes after them, and convertAlone() converts each of them again in a
+    process of its own, so that only the note that kills its worker fails.
+    A process forked while another thread holds a lock can hang on it, so
+    processes are only forked under lock, which readAhead holds while it
+    reads
+    """
+    def __init__(self, jobs, initargs):
+        self.jobs = jobs
+        self.initargs = initargs
+        self.lock = threading.Lock()
+        # notes submitted so far, the first restartedAt of them to a pool that broke
+        self.submitted = 0
+        self.restartedAt = 0
+        self.executor = self.start(jobs)
+
+    def start(self, jobs):
+        executor = ProcessPoolExecutor(jobs, initializer=initWorker, initargs=self.initargs)
+        # fork the workers now rather than with the first note
+        executor.submit(os.getpid).result()
+        return executor
+
+    def submit(self, path, parsed, files):
+        with self.lock:
+            self.submitted += 1
+            try:
+                return self.executor.submit(encodeJsonFileInWorker, path, parsed, files)
+            except BrokenProcessPool as e:
+                failed = Future()
+                failed.set_exception(e)
+                return failed
+
+    def restart(self, index):
+        "Replaces the pool, unless the note submitted index-th went to one replaced already"
+        with self.lock:
+            if index < self.restartedAt: return
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.start(self.jobs)
+            self.restartedAt = self.submitted
+
+    def convertAlone(self, path, parsed, files):
+        with self.lock:
+            executor = self.start(1)
         try:
-            note = extractNoteFromJsonFile(inputPath, inputDir)
-
-            # enex file template
-            enexXML = Template("""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export4.dtd">
-<en-export application="Evernote" version="Evernote">
-    <note>
-        <title>${note.title}</title>
-        <created>${note.datestamp}</created>
-        <updated>${note.datestamp}</updated>
-        <note-attributes>
-            <author>${note.author}</author>
-        </note-attributes>
-        <content>
-            <![CDATA[<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-            <!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
-            <en-note>
-                <div style="word-wrap: break-word; -webkit-nbsp-mode: space; -webkit-line-break: after-white-space;">${note.text}</div>
-                % for attachment in note.attachments:
-                <en-media style="--en-naturalWidth:${attachment["width"]}; --en-naturalHeight:${attachment["height"]};" hash="${attachment["hash"]}" type="${attachment["mimetype"]}" />
-                % endfor
-            </en-note>
-            ]]>
-        </content>
-
-        % for attachment in note.attachments:
-        <resource>
-            <data encoding="base64">
-${attachment["data"]}
-            </data>
-            <mime>${attachment["mimetype"]}</mime>
-            % if attachment["width"]:
-            <width>${attachment["width"]}</width>
-            % endif
-            % if attachment["height"]:
-            <height>${attachment["height"]}</height>
-            % endif
-            <resource-attributes>
-                <file-name>${attachment["filename"]}</file-name>
-                <source-url></source-url>
-            </resource-attributes>
-        </resource>
-        % endfor
-
-        % for label in note.labels:
-        <tag>${label}</tag>
-        % endfor
-    </note>
-</en-export>
-""")
-
-            with codecs.open(outfname, 'w', 'utf-8') as outfile:
-                outfile.write(enexXML.render(note=note))
-                fileCount += 1
-        except Exception as e:
-            indexErrorCount += 1
-            msg("error: " + inputPath)
-            print(e)
+            return executor.submit(encodeJsonFileInWorker, path, parsed, files).result()
+        except BrokenProcessPool:
+            return NoteResult(path, error=ConversionError("the worker process converting it died"))
+        finally:
+            executor.shutdown()
+
+    def shutdown(self, cancel_futures=False):
+        self.executor.shutdown(cancel_futures=cancel_futures)
+
+def readAhead(paths, source, knownHashes, encode, budget, pending, stopped, readLock):
+    """
+    The reading stage of --pipeline: reads each json file and the attachments
+    it references, in order, under readLock, and hands them to encode(). The
+    futures go into the bounded pending queue with what they were given,
+    followed by None. Notes whose hash matches knownHashes go in as they are,
+    without reading their attachments
+    """
+    try:
+        for path in paths:
+            if stopped.is_set(): return
+            noteHash = None
+            try:
+                with readLock:
+                    parsed = readJsonFile(path, source)
+                    noteHash = hashJsonFile(parsed[0], parsed[1], source)
+                    attachmentPaths = set(source.attachmentPath(a["filePath"].replace(".jpeg", ".jpg"))
+                                          for a in parsed[1].get("attachments", []))
+                    # attachments larger than the whole budget are streamed when the note is written
+                    sizes = dict((p, source.size(p)) for p in attachmentPaths)
+                sizes = dict((p, n) for p, n in sizes.items() if n <= budget.limit)
+            except Exception:
+                # converting the note reports the error
+                parsed, sizes = None, {}
 
-def jsonDirToEnex(inputDir, outputDir):
-    try_rmtree(outputDir)
-    try_mkdir(outputDir)
-    msg("Building enex files in {0} ...".format(outputDir))
+            if noteHash is not None and knownHashes.get(os.path.basename(path)) == noteHash:
+                unchanged = Future()
+                unchanged.set_result(NoteResult(path, noteHash=noteHash, unchanged=True))
+                pending.put((unchanged, 0, None))
+                continue
+            held = len(parsed[0]) if parsed else 0
+            held += sum(sizes.values())
+            budget.take(held)
+            files = {}
+            with readLock:
+                for attachmentPath in sizes:
+                    with instrument.stage("attachment read"), source.open(attachmentPath) as f:
+                        files[attachmentPath] = f.read()
+            pending.put((encode(path, parsed, files), held, (path, parsed, files)))
+    except BaseException as e:
+        failed = Future()
+        failed.set_exception(e)
+        pending.put((failed, 0, None))
+    finally:
+        pending.put((None, 0, None))
 
-    for path in glob.glob(os.path.join(inputDir, "*.json")):
-        jsonFileToEnex(path, outputDir, inputDir)
+def pipelineJsonFiles(paths, source, knownHashes, options):
+    """
+    Yields a NoteResult per path, in order, from a pipeline of a reader
+    thread, encoders (--jobs worker processes, or a thread) and the caller,
+    which writes the notes. The stages run at the same time, the budget and
+    the bounded queue between them stop the reader from getting too far ahead
+    """
+    if options.jobs > 1:
+        # the workers are started before the reader thread
+        executor = WorkerPool(options.jobs, (options, source, knownHashes, instrument.enabled))
+        encode = executor.submit
+        readLock = executor.lock
+    else:
+        executor = ThreadPoolExecutor(1)
+        encode = lambda path, parsed, files: executor.submit(encodeJsonFile, path, source, options, knownHashes, parsed, files)
+        readLock = threading.Lock()
 
-    global fileCount, indexErrorCount
-    msg("Done. Imported %s json files. Errors: %s." % (fileCount, indexErrorCount))
+    budget = ByteBudget(options.pipelineMB * 1024 * 1024)
+    pending = queue.Queue(4 * max(options.jobs, 2))
+    stopped = threading.Event()
+    reader = threading.Thread(target=readAhead, args=(paths, source, knownHashes, encode, budget, pending, stopped, readLock), daemon=True)
+    reader.start()
+    try:
+        index = 0
+        while True:
+            future, held, task = pending.get()
+            if future is None: break
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                executor.restart(index)
+                result = executor.convertAlone(*task)
+            # counts the notes submitted to the encoders, as WorkerPool.submitted does
+            if task is not None:
+                index += 1
+            yield result
+            budget.give(held)
+    finally:
+        # let a reader blocked on the budget or the queue run to its end
+        stopped.set()
+        budget.close()
+        while reader.is_alive():
+            try:
+                pending.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown(cancel_futures=True)
+
+def readChunks(f):
+    "Yields the contents of f in dataChunkSize pieces"
+    while True:
+        with instrument.stage("attachment read"):
+            chunk = f.read(dataChunkSize)
+            while chunk and len(chunk) % 3 and len(chunk) < dataChunkSize:
+                more = f.read(dataChunkSize - len(chunk))
+                if not more: break
+                chunk += more
+        if not chunk: return
+        yield chunk
+
+def writeAttachmentData(source, attachment, write):
+    """
+    Streams the base64 body of an attachment from its source file, or from
+    the cache when the same data was written before. Attachments encoded by
+    the --pipeline carry their data. Otherwise this runs in the writing
+    process even with --jobs, where the workers only hash the attachments:
+    reading them again and encoding them here is the cost of not keeping
+    the encodings of every note in flight, which --pipeline bounds instead
+    """
+    if "data" in attachment:
+        write(attachment["data"])
+        return
+    if cache.writeEncoding(attachment["hash"], write, dataChunkSize * 4 // 3):
+        instrument.count("cached encodings")
+        return
+
+    encoding = cache.encodingWriter(attachment["hash"], attachment["size"])
+    try:
+        with source.open(attachment["path"]) as f:
+            for chunk in readChunks(f):
+                with instrument.stage("base64 encode"):
+                    data = base64.b64encode(chunk).decode("ascii")
+                write(data)
+                if encoding is not None:
+                    encoding.write(data)
+    except BaseException:
+        if encoding is not None:
+            encoding.discard()
+        raise
+    if encoding is not None:
+        encoding.commit()
+
+class Manifest:
+    """
+    Records the hash of each converted json file and the .enex file it was
+    written to, so that --incremental runs can skip notes that haven't
+    changed. Entries are appended to manifest.jsonl in the output directory
+    as each .enex file is completed, so an interrupted run resumes after the
+    last complete file. Without an output directory, for a zip bundle, the
+    entries are only kept in memory.
+
+    A changed note is written to a new file, and a note whose json file is
+    gone is recorded without a file and hash by removeMissing. Their old
+    file is removed once no other note is recorded in it, always the case
+    with one note per file
+    """
+    fileName = "manifest.jsonl"
+
+    def __init__(self, outputDir):
+        self.outputDir = outputDir
+        self.path = os.path.join(outputDir, self.fileName) if outputDir else None
+        self.entries = {}
+        self.needsNewline = False
+        # .enex file -> number of notes recorded in it
+        self.fileNotes = collections.Counter()
+        self.removedFiles = 0
+
+        if self.path is None or not os.path.isfile(self.path): return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self.needsNewline = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # cut short by a crash
+                self.entries[entry["name"]] = entry
+        for entry in self.entries.values():
+            if entry["file"]:
+                self.fileNotes[entry["file"]] += 1
+
+    def knownHashes(self):
+        return dict((name, entry["hash"]) for name, entry in self.entries.items())
+
+    def nextFileNumber(self):
+        numbers = [int(entry["file"].split(".")[0]) for entry in self.entries.values() if entry["file"]]
+        return max(numbers) + 1 if numbers else 0
+
+    def add(self, entries):
+        if self.path is None:
+            self.entries.update((entry["name"], entry) for entry in entries)
+            return
+        superseded = []
+        with open(self.path, "a", encoding="utf-8") as f:
+            if self.needsNewline:
+                f.write("\n")
+                self.needsNewline = False
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+                old = self.entries.get(entry["name"])
+                if old is not None and old["file"]:
+                    self.fileNotes[old["file"]] -= 1
+                    superseded.append(old["file"])
+                if entry["file"]:
+                    self.fileNotes[entry["file"]] += 1
+                self.entries[entry["name"]] = entry
+        # only once the entries that replace them are recorded
+        for fileName in superseded:
+            if self.fileNotes[fileName] <= 0 and os.path.isfile(os.path.join(self.outputDir, fileName)):
+                del self.fileNotes[fileName]
+                os.remove(os.path.join(self.outputDir, fileName))
+                self.removedFiles += 1
+
+    def removeMissing(self, names):
+        "Records the notes that aren't in names, whose json files are gone, as deleted"
+        self.add([{"name": name, "hash": None, "file": None} for name, entry in self.entries.items()
+                  if name not in names and entry["hash"] is not None])
+
+class EnexWriter:
+    """
+    Writes notes to numbered .enex files in a sink, see outputSink.py. A new
+    file is started once notesPerFile notes (0 for no limit) have been written
+    to the current one, or when the next note would take it past maxFileBytes,
+    counted before compression.
+    Notes are rendered straight into a plain file and attachment data is
+    streamed from the source, so no note is held in memory as a whole. A
+    compressed file can't be rewound to take back a note that failed halfway,
+    so notes for one are rendered into a spool file first, see
+    outputSink.spooled. Completed files are recorded in the manifest, along
+    with the notes skipped since the previous one
+    """
+    def __init__(self, sink, notesPerFile=1, maxFileBytes=0, manifest=None, fileNumber=0):
+        self.sink = sink
+        self.notesPerFile = notesPerFile
+        self.maxFileBytes = maxFileBytes
+        self.manifest = manifest
+        self.fileNumber = fileNumber
+        self.firstFileNumber = fileNumber
+        self.outfile = None
+        self.outname = None
+        # where write() goes, the file or the spool of the note being rendered
+        self.target = None
+        # bytes written to the file, before compression
+        self.size = 0
+        self.noteCount = 0
+        self.manifestEntries = []
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        with instrument.stage("file write"):
+            self.target.write(data)
+        self.size += len(data)
+
+    def isFull(self, note):
+        if self.notesPerFile and self.noteCount >= self.notesPerFile: return True
+        return self.maxFileBytes and self.size + note.estimatedSize() > self.maxFileBytes
+
+    def open(self):
+        self.outname = str(self.fileNumber) + ".enex"
+        self.outfile = self.target = self.sink.open(self.outname)
+        self.size = 0
+        self.noteCount = 0
+        self.write(enexTemplates.exportHeader)
+
+    def render(self, note, source):
+        from mako.runtime import Context
+        with instrument.stage("template render"):
+            context = Context(self, note=note, writeData=partial(writeAttachmentData, source))
+            enexTemplates.keepNoteEnex.render_context(context)
+
+    def writeNote(self, note, source, name=None, noteHash=None, digest=None):
+        if self.outfile is not None and self.noteCount > 0 and self.isFull(note):
+            self.close()
+        if self.sink.seekable:
+            self.writeNoteInPlace(note, source)
+        else:
+            self.writeNoteSpooled(note, source)
+        self.noteCount += 1
+        entry = {"name": name, "hash": noteHash, "file": os.path.basename(self.sink.path(self.outname))}
+        if digest is not None:
+            entry["digest"] = digest.hex()
+        self.manifestEntries.append(entry)
+
+    def skipNote(self, name):
+        """
+        Records a note that isn't written, a duplicate. It is recorded
+        without its hash, so that --incremental runs check it again: the
+        note it is a copy of can change or go away
+        """
+        entry = {"name": name, "hash": None, "file": None}
+        if self.manifest is not None and self.manifest.entries.get(name) == entry:
+            return
+        self.manifestEntries.append(entry)
+
+    def writeNoteInPlace(self, note, source):
+        if self.outfile is None:
+            self.open()
+        start = self.size
+        try:
+            self.render(note, source)
+        except BaseException:
+            # drop the partly written note, and the file if it holds nothing else
+            self.outfile.seek(start)
+            self.outfile.truncate()
+            self.size = start
+            if self.noteCount == 0:
+                self.sink.discard(self.outname, self.outfile)
+                self.outfile = None
+            raise
+
+    def writeNoteSpooled(self, note, source):
+        start = self.size
+        with outputSink.spooled(self.openedFile, dataChunkSize) as spool:
+            self.target = spool
+            try:
+                self.render(note, source)
+            finally:
+                self.target = self.outfile
+                noteSize = self.size - start
+                self.size = start
+        self.size += noteSize
+
+    def openedFile(self):
+        "The file notes go into, started once its first note is complete"
+        if self.outfile is None:
+            self.open()
+        return self.outfile
+
+    def close(self):
+        if self.outfile is not None:
+            self.write(enexTemplates.exportFooter)
+            self.outfile.close()
+            self.outfile = self.target = None
+            self.fileNumber += 1
+        if self.manifest is not None and self.manifestEntries:
+            self.manifest.add(self.manifestEntries)
+        self.manifestEntries = []
+
+def jsonFileToEnex(result, writer, number, source, defaultTitle):
+    "Writes a converted note, untitled notes are named after their number"
+    try:
+        if result.error is not None:
+            raise result.error
+        note = result.note
+        note.numberTitle(number + 1, defaultTitle)
+
+        writer.writeNote(note, source, result.name, result.noteHash, result.digest)
+        result.fileCount += 1
+    except Exception as e:
+        result.indexErrorCount += 1
+        msg("error: " + result.inputPath)
+        print(e)
+
+def removeUnrecordedEnexFiles(outputDir, fileNumber):
+    "Removes .enex and .enex.gz files left from fileNumber on by an interrupted run"
+    for path in glob.glob(os.path.join(outputDir, "*.enex")) + glob.glob(os.path.join(outputDir, "*.enex.gz")):
+        name = os.path.basename(path).split(".")[0]
+        if name.isdigit() and int(name) >= fileNumber:
+            os.remove(path)
+
+def getCache(memoryBudget):
+    "The attachment cache, kept from one conversion to the next in the same process"
+    global cache
+    if cache is None or cache.memoryBudget != memoryBudget:
+        if cache is not None:
+            cache.close()
+        cache = attachmentCache.AttachmentCache(memoryBudget)
+    return cache
+
+def jsonDirToEnex(source, outputDir, options):
+    "Converts the notes of source into outputDir, returns the counts it prints at the end"
+    getCache(options.cacheMB * 1024 * 1024)
+    if options.compress == "zip":
+        if options.incremental:
+            raise ConversionError("--incremental can't add to a zip bundle")
+        manifest = Manifest(None)
+        msg("Building {0}.zip ...".format(outputDir))
+    elif options.incremental and os.path.isdir(outputDir):
+        manifest = Manifest(outputDir)
+        removeUnrecordedEnexFiles(outputDir, manifest.nextFileNumber())
+        msg("Updating enex files in {0} ...".format(outputDir))
+    else:
+        try_rmtree(outputDir)
+        try_mkdir(outputDir)
+        manifest = Manifest(outputDir)
+        msg("Building enex files in {0} ...".format(outputDir))
+
+    # --maxFileBytes on its own packs as many notes as fit into each file
+    notesPerFile = options.notesPerFile if options.notesPerFile is not None else (0 if options.maxFileBytes else 1)
+    sink = outputSink.openSink(outputDir, options.compress, options.compressLevel, options.writeBufferKB * 1024)
+    writer = EnexWriter(sink, notesPerFile, options.maxFileBytes, manifest, manifest.nextFileNumber())
+    digests = None
+    if options.dedup:
+        digests = noteDigests.DigestSet()
+
+    # untitled notes keep counting from the previous run
+    fileCount = len(manifest.entries)
+    importCount = 0
+    indexErrorCount = 0
+    unchangedCount = 0
+    duplicateCount = 0
+    names = set()
+    try:
+        convert = pipelineJsonFiles if options.pipeline else convertJsonFiles
+        for result in convert(source.jsonPaths(), source, manifest.knownHashes(), options):
+            names.add(result.name)
+            instrument.merge(result.stats)
+            if result.unchanged:
+                result.unchangedCount += 1
+                # written by an earlier run and still there, the json files come in the same order
+                entry = manifest.entries[result.name]
+                if digests is not None and entry["file"] and entry.get("digest"):
+                    digests.add(bytes.fromhex(entry["digest"]))
+            elif result.digest is not None and result.digest in digests:
+                result.duplicateCount += 1
+                writer.skipNote(result.name)
+            else:
+                jsonFileToEnex(result, writer, fileCount, source, options.defaultTitle)
+                # a note that failed doesn't count, a later copy of it is written
+                if result.digest is not None and result.fileCount:
+                    digests.add(result.digest)
+            fileCount += result.fileCount
+            importCount += result.fileCount
+            indexErrorCount += result.indexErrorCount
+            unchangedCount += result.unchangedCount
+            duplicateCount += result.duplicateCount
+    finally:
+        try:
+            writer.close()
+        finally:
+            sink.close()
+            if digests is not None:
+                digests.close()
+        cache.endConversion()
+        imageSizes.clear()
+    # only after going through every json file, an interrupted run hasn't seen them all
+    manifest.removeMissing(names)
+
+    instrument.count("notes", importCount)
+    instrument.count("errors", indexErrorCount)
+    instrument.count("unchanged", unchangedCount)
+    instrument.count("duplicates", duplicateCount)
+    instrument.count("enex files", writer.fileNumber - writer.firstFileNumber)
+    msg("Done. Imported %s json files into %s enex files. Unchanged: %s. Duplicates: %s. Errors: %s." % (
+        importCount, writer.fileNumber - writer.firstFileNumber, unchangedCount, duplicateCount, indexErrorCount))
+    if options.incremental and writer.fileNumber > writer.firstFileNumber:
+        msg("New and changed notes are in enex files %s to %s." % (writer.firstFileNumber, writer.fileNumber - 1))
+    if manifest.removedFiles:
+        msg("Removed %s enex files of changed or deleted notes." % manifest.removedFiles)
+    return {
+        "notes": importCount,
+        "enexFiles": writer.fileNumber - writer.firstFileNumber,
+        "unchanged": unchangedCount,
+        "duplicates": duplicateCount,
+        "errors": indexErrorCount,
+    }
 
 def tryUntilDone(action, check):
     ex = None
@@ -115,7 +887,7 @@ def tryUntilDone(action, check):
         time.sleep(1)
         i += 1
 
-    sys.exit(ex if ex != None else "Failed")
+    raise ConversionError(ex if ex != None else "Failed")
 
 def try_rmtree(folder):
     if os.path.isdir(folder): msg("Removing {0}".format(folder))
@@ -130,25 +902,69 @@ def try_mkdir(folder):
     tryUntilDone(act, check)
 
 class Note:
-    def __init__(self, title, text, labels, dtime, attachments):
-        self.title = title or args.defaultTitle
+    def __init__(self, title, text, labels, dtime, attachments, author):
+        self.title = title
         self.text = text
         self.labels = labels
         self.datetime = dtime
         self.datestamp = dtime.strftime("%Y%m%dT%H%M%SZ")
-        self.author = args.author
+        self.author = author
         self.attachments = attachments
 
-def extractNoteFromJsonFile(inputPath, inputDir):
+    def estimatedSize(self):
+        "Rough size of the rendered note in bytes, attachments are base64 encoded"
+        return 2048 + len(self.text.encode("utf-8")) + sum(a["size"] * 4 // 3 for a in self.attachments)
+
+    def digest(self):
+        "Digest of the title, text and attachments for --dedup, taken before untitled notes are numbered"
+        with instrument.stage("hashing"):
+            return noteDigests.noteDigest(self.title, self.text, [a["hash"] for a in self.attachments])
+
+    def numberTitle(self, number, defaultTitle):
+        "Untitled notes are named after their position in the export"
+        if not self.title:
+            self.title = (defaultTitle + " #" + str(number)).strip()
+
+def textToEnml(text):
     """
-    Extracts the note heading (containing the ctime), text, and labels from
-    an exported Keep HTML file
+    Note text as ENML, with &, < and > escaped and line breaks as <br/>.
+    Each str.replace is one pass in C, which beats str.translate with its
+    multi-character replacements
     """
-    global fileCount
+    for char, replacement in enmlText:
+        if char in text:
+            text = text.replace(char, replacement)
+    return text
 
-    with codecs.open(inputPath, 'r', 'utf-8') as myfile:
+def readJsonFile(inputPath, source):
+    """
+    Returns the raw bytes and the parsed contents of a Keep json file, parsed
+    with orjson when it is installed
+    """
+    with instrument.stage("json read"), source.open(inputPath) as myfile:
         data = myfile.read()
-    note = json.loads(data)
+    with instrument.stage("json parse"):
+        if orjson is not None:
+            try:
+                return data, orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass  # json reports the error, or reads what orjson won't, like integers past 64 bits
+        return data, json.loads(data.decode("utf-8"))
+
+def hashJsonFile(data, note, source):
+    "Hash of a Keep json file and the attachments it references, as recorded in the manifest"
+    with instrument.stage("hashing"):
+        sha1 = hashlib.sha1(data)
+        for attachment in note.get("attachments", []):
+            path = source.attachmentPath(attachment["filePath"].replace(".jpeg", ".jpg"))
+            sha1.update(source.fingerprint(path).encode("utf-8"))
+        return sha1.hexdigest()
+
+def extractNoteFromJsonFile(inputPath, source, note, options):
+    """
+    Extracts the note heading (containing the ctime), text, and labels from
+    an exported Keep HTML file, given its parsed json
+    """
     title = note.get("title", "").strip()
 
     # edit title if length too long
@@ -156,33 +972,25 @@ def extractNoteFromJsonFile(inputPath, inputDir):
         note.text = "title: " + title + "\n\n" + note.text
         title = title[:251]
 
-    if not title:
-        title = (args.defaultTitle + " #" + str(fileCount + 1)).strip()
-
-    text = ""
     if "listContent" in note:
-        for li in note.get("listContent"):
-            text += "<li>" + li.get("text") + "</li>"
-        text = "<ul>" + text + "</ul>"
+        text = "<ul>" + "".join("<li>" + textToEnml(li.get("text")) + "</li>" for li in note.get("listContent")) + "</ul>"
     else:
-        text = note.get("textContent", "")
-
-    text = text.strip().replace('\n', '<br/>').replace('\r', '<br/>').replace('&', '&amp;')
+        text = textToEnml(note.get("textContent", "").strip())
 
     labels = [t["name"].strip() for t in note.get("labels", [])]
     if note["isArchived"]:
         labels.append("archived")
     if note["isTrashed"]:
         labels.append("keep:trash")
-        if not args.includeTrashed:
-            print("is trashed: %s" % str(fileCount))
+        if not options.includeTrashed:
+            print("is trashed: %s" % inputPath)
             print(note)
             raise Exception("Is Trashed")
     if note["isPinned"]:
         labels.append("keep:pinned")
 
-    if args.addLabel:
-        labels.append(args.addLabel)
+    if options.addLabel:
+        labels.append(options.addLabel)
 
     dtime = datetime.utcfromtimestamp(note.get("userEditedTimestampUsec") / 1000 / 1000)
     if not note.get("userEditedTimestampUsec"):
@@ -193,80 +1001,208 @@ def extractNoteFromJsonFile(inputPath, inputDir):
 
     attachments = []
     for attachment in note.get("attachments", []):
-        path = os.path.join(inputDir, attachment["filePath"].replace(".jpeg", ".jpg"))
+        path = source.attachmentPath(attachment["filePath"].replace(".jpeg", ".jpg"))
+        attachment["filename"] = attachment["filePath"]
+        attachment["path"] = path
 
-        with codecs.open(path, "rb") as image_file:
-            data = image_file.read()
-            attachment["data"] = base64.b64encode(data).decode("utf-8")
-            attachment["filename"] = attachment["filePath"]
-            attachment["hash"] = hashlib.md5(data).hexdigest()
-            attachment["path"] = path
-
-            try:
-                img = Image.open(path)
-                attachment["width"] = img.width
-                attachment["height"] = img.height
-            except Exception as e:
-                attachment["width"] = ""
-                attachment["height"] = ""
-                print(e)
-                print("file: %s" % str(fileCount))
+        key = source.cacheKey(path)
+        info = cache.fileInfo(key)
+        if info is not None:
+            instrument.count("cached attachments")
+        else:
+            with source.open(path) as image_file:
+                # the data itself is streamed again when the note is written
+                md5 = hashlib.md5()
+                header = None
+                size = 0
+                for chunk in readChunks(image_file):
+                    if header is None: header = chunk
+                    with instrument.stage("hashing"):
+                        md5.update(chunk)
+                    size += len(chunk)
+                attachment["hash"] = md5.hexdigest()
+                with instrument.stage("image probe"):
+                    width, height = attachmentSize(attachment, header or b"")
+            info = (attachment["hash"], size, width, height)
+            cache.addFileInfo(key, info)
+        attachment["hash"], attachment["size"], attachment["width"], attachment["height"] = info
 
         attachments.append(attachment)
+        instrument.count("attachments")
+        instrument.count("attachment bytes", attachment["size"])
+
+    return Note(title, text, labels, dtime, attachments, options.author)
 
-    return Note(title, text, labels, dtime, attachments)
+def attachmentSize(attachment, header):
+    """
+    Returns (width, height) of an image attachment, memoized by its MD5 since
+    Keep often reuses the same image across notes. The size is read from the
+    header bytes and PIL is only imported for images the probe can't read
+    """
+    if attachment["hash"] in imageSizes: return imageSizes[attachment["hash"]]
+
+    size = imageSize.probeSize(header)
+    if size is None and attachment.get("mimetype", "").startswith("image/"):
+        try:
+            from PIL import Image
+            img = Image.open(io.BytesIO(header))
+            size = (img.width, img.height)
+        except Exception as e:
+            print(e)
+            print("file: %s" % attachment["path"])
+
+    imageSizes[attachment["hash"]] = size or ("", "")
+    return imageSizes[attachment["hash"]]
+
+def isKeepNote(data):
+    "Whether the bytes of a json file look like a Keep note"
+    try:
+        note = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return False
+    return isinstance(note, dict) and ("isTrashed" in note or "userEditedTimestampUsec" in note)
+
+def findKeepDir(jsonFiles, keepDir, read):
+    """
+    Picks the Keep folder of an export, given the .json files in each
+    folder beneath Takeout. Other products (Chrome, Fit, ...) have json
+    files too: keepDir is taken when it has any, otherwise the folder whose
+    first few json files include a Keep note, for exports with a localized
+    name. read(path) returns the bytes of a file
+    """
+    if keepDir in jsonFiles: return keepDir
+    for dir, paths in jsonFiles.items():
+        for path in paths[:keepProbeCount]:
+            try:
+                if isKeepNote(read(path)): return dir
+            except (IOError, KeyError, zipfile.BadZipfile):
+                continue
+    return None
+
+def readFile(path):
+    with open(path, "rb") as f:
+        return f.read()
 
 def getJsonDir(takeoutDir):
-    "Returns first subdirectory beneath takeoutDir which contains .json files"
-    dirs = [os.path.join(takeoutDir, s) for s in os.listdir(takeoutDir)]
-    for dir in dirs:
+    "Returns the Keep subdirectory beneath takeoutDir, see findKeepDir"
+    jsonFiles = {}
+    for s in sorted(os.listdir(takeoutDir)):
+        dir = os.path.join(takeoutDir, s)
         if not os.path.isdir(dir): continue
-        htmlFiles = [f for f in os.listdir(dir) if jsonExt.search(f)]
-        if len(htmlFiles) > 0: return dir
+        names = sorted(f for f in os.listdir(dir) if jsonExt.search(f))
+        if names: jsonFiles[dir] = [os.path.join(dir, f) for f in names]
+    return findKeepDir(jsonFiles, os.path.join(takeoutDir, "Keep"), readFile)
+
+def getZipJsonDir(names, read):
+    "Returns the Keep directory beneath Takeout/ among the zip entry names, see findKeepDir"
+    jsonFiles = {}
+    for name in names:
+        dir = posixpath.dirname(name)
+        if posixpath.dirname(dir) == "Takeout" and jsonExt.search(name): jsonFiles.setdefault(dir, []).append(name)
+    return findKeepDir(jsonFiles, "Takeout/Keep", read)
+
+def convertKeep(zipFileNames, options=None, outputDir=None):
+    """
+    Converts the Keep notes in a Takeout export to .enex files in outputDir,
+    by default Evernote_Files next to the export. zipFileNames is the zip or
+    a list of the volumes of a split export, options a KeepOptions. Returns
+    the number of notes, enexFiles, unchanged notes, duplicates and errors.
+    Raises ConversionError when the export can't be read. The templates and
+    the caches are kept for the next call
+    """
+    if isinstance(zipFileNames, str):
+        zipFileNames = [zipFileNames]
+    return keepZipToOutput(list(zipFileNames), options or KeepOptions(), outputDir)
+
+def keepZipToOutput(zipFileNames, options, outputDir=None):
+    "Converts the Keep notes in a Takeout export, given the zip of each of its volumes"
+    zipFileDir = os.path.dirname(zipFileNames[0])
+    outputDir = outputDir or os.path.join(zipFileDir, "Evernote_Files")
+    if not options.extract:
+        return keepZipStreamToOutput(zipFileNames, options, outputDir)
 
-def keepZipToOutput(zipFileName):
-    zipFileDir = os.path.dirname(zipFileName)
     takeoutDir = os.path.join(zipFileDir, "Takeout")
 
     try_rmtree(takeoutDir)
 
-    if os.path.isfile(zipFileName):
-        msg("Extracting {0} ...".format(zipFileName))
+    for zipFileName in zipFileNames:
+        if os.path.isfile(zipFileName):
+            msg("Extracting {0} ...".format(zipFileName))
 
-    try:
-        with ZipFile(zipFileName) as zipFile:
-            zipFile.extractall(zipFileDir)
-    except (IOError, zipfile.BadZipfile) as e:
-        sys.exit(e)
+        try:
+            with ZipFile(zipFileName) as zipFile:
+                zipFile.extractall(zipFileDir)
+        except (IOError, zipfile.BadZipfile) as e:
+            raise ConversionError(e)
 
     jsonDir = getJsonDir(takeoutDir)
-    if jsonDir is None: sys.exit("No Keep directory found")
+    if jsonDir is None: raise ConversionError("No Keep directory found")
 
     msg("Keep dir: " + jsonDir)
 
-    jsonDirToEnex(inputDir=jsonDir, outputDir=os.path.join(zipFileDir, "Evernote_Files"))
+    summary = jsonDirToEnex(KeepDirSource(jsonDir), outputDir, options)
 
     msg("cleaning up...")
     try_rmtree(takeoutDir)
+    return summary
 
-def getArgs():
+def keepZipStreamToOutput(zipFileNames, options, outputDir):
+    "Converts the Keep notes in the zips without extracting them"
+    msg("Reading {0} ...".format(", ".join(zipFileNames)))
+
+    try:
+        zipFiles, index = openVolumes(zipFileNames)
+    except (IOError, zipfile.BadZipfile) as e:
+        raise ConversionError(e)
+
+    jsonDir = getZipJsonDir(index, lambda name: zipFiles[index[name]].read(name))
+    if jsonDir is None:
+        for zipFile in zipFiles:
+            zipFile.close()
+        raise ConversionError("No Keep directory found")
+
+    msg("Keep dir: " + jsonDir)
+
+    source = KeepZipSource(zipFileNames, jsonDir, index, zipFiles)
+    try:
+        return jsonDirToEnex(source, outputDir, options)
+    finally:
+        source.close()
+
+def getArgs(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("zipFile")
+    parser.add_argument("zipFile", nargs="+", help="the Takeout zip, or each volume of a split export")
     parser.add_argument("--encoding", default=sys.stdin.encoding or "utf-8")
-    parser.add_argument("--author", default="Anonymous")
-    parser.add_argument("--defaultTitle", default="")
-    parser.add_argument("--includeTrashed", default=False)
-    parser.add_argument("--addLabel", default=None)
-    return parser.parse_args()
+    parser.add_argument("--author", default=KeepOptions.author)
+    parser.add_argument("--defaultTitle", default=KeepOptions.defaultTitle)
+    parser.add_argument("--includeTrashed", default=KeepOptions.includeTrashed)
+    parser.add_argument("--addLabel", default=KeepOptions.addLabel)
+    parser.add_argument("--extract", default=KeepOptions.extract)
+    parser.add_argument("--jobs", default=KeepOptions.jobs, type=int)
+    parser.add_argument("--notesPerFile", default=KeepOptions.notesPerFile, type=int)
+    parser.add_argument("--maxFileBytes", default=KeepOptions.maxFileBytes, type=int)
+    parser.add_argument("--incremental", default=KeepOptions.incremental)
+    parser.add_argument("--cacheMB", default=KeepOptions.cacheMB, type=int, help="memory for base64 encodings of repeated attachments, 0 to turn off")
+    parser.add_argument("--pipeline", default=KeepOptions.pipeline, help="read, encode and write notes at the same time")
+    parser.add_argument("--pipelineMB", default=KeepOptions.pipelineMB, type=int, help="memory for notes read ahead by --pipeline")
+    parser.add_argument("--compress", default=KeepOptions.compress, choices=outputSink.compressions,
+                        help="write .enex.gz files, or one Evernote_Files.zip")
+    parser.add_argument("--compressLevel", default=KeepOptions.compressLevel, type=int)
+    parser.add_argument("--writeBufferKB", default=KeepOptions.writeBufferKB, type=int)
+    parser.add_argument("--dedup", default=KeepOptions.dedup, help="skip notes with the same title, text and attachments as one already written")
+    parser.add_argument("--report", default=None, help="write per-stage timings as json to this file")
+    parser.add_argument("--profile", default=None, help="write a cProfile dump of the run to this file")
+    return parser.parse_args(argv)
 
 def main():
-    global args
     args = getArgs()
 
     print(vars(args))
 
     try:
-        keepZipToOutput(args.zipFile)
+        instrument.run(lambda: convertKeep(args.zipFile, KeepOptions.fromArgs(args)), args.report, args.profile)
+    except ConversionError as ex:
+        sys.exit(ex)
     except WindowsError as ex:
         sys.exit(ex)
     except InvalidEncoding as ex:
@@ -0,0 +1,131 @@
+"""
+Streaming reader for OneNote .mht exports.
+
+The file is scanned line by line. Only the text/html parts are kept in
+memory, other parts (images and other media) are indexed by their offset
+in the file and read back when their payload is asked for.
+"""
+import base64, quopri
+from email.parser import BytesHeaderParser
+
+class MhtPart:
+    """
+    A MIME part of an mht file, with the parts of the email.message.Message
+    interface that onenoteToEnex uses
+    """
+    def __init__(self, path, headers, start, end, body=None):
+        self.path = path
+        self.headers = headers
+        self.start = start
+        self.end = end
+        self.body = body
+
+    def get(self, name, failobj=None):
+        return self.headers.get(name, failobj)
+
+    def get_content_type(self):
+        return self.headers.get_content_type()
+
+    def is_multipart(self):
+        return False
+
+    def read_body(self):
+        if self.body is not None:
+            return self.body
+        with open(self.path, "rb") as f:
+            f.seek(self.start)
+            return f.read(self.end - self.start)
+
+    def iter_body(self, chunk_size=64 * 1024):
+        "Yields the raw body a chunk at a time, without reading all of it into memory"
+        if self.body is not None:
+            yield self.body
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def get_payload(self, decode=False):
+        body = self.read_body()
+        if not decode:
+            return body.decode("ascii", "surrogateescape")
+
+        encoding = self.headers.get("content-transfer-encoding", "").strip().lower()
+        if encoding == "base64":
+            data = b"".join(body.splitlines())
+            return base64.b64decode(data + b"=" * (-len(data) % 4))
+        if encoding == "quoted-printable":
+            return quopri.decodestring(body)
+        return body
+
+def read_headers(f):
+    "Reads a header block up to and including the blank line that ends it"
+    lines = []
+    for line in f:
+        lines.append(line)
+        if line in (b"\r\n", b"\n"):
+            break
+    return BytesHeaderParser().parsebytes(b"".join(lines))
+
+def strip_newline(line):
+    return line.rstrip(b"\r\n")
+
+def read_mht(path):
+    """
+    Returns (message headers, parts) for the mht file at path. Parts of a
+    multipart message are MhtPart objects, a single part message is returned
+    as one MhtPart holding the whole body
+    """
+    with open(path, "rb") as f:
+        headers = read_headers(f)
+        if headers.get_content_maintype() != "multipart":
+            start = f.tell()
+            body = f.read()
+            return headers, [MhtPart(path, headers, start, start + len(body), body)]
+
+        delimiter = b"--" + headers.get_boundary().encode("ascii")
+        parts = []
+        part_headers = None
+        start = end = 0
+        lines = None
+
+        def finish_part():
+            # the line break before a delimiter belongs to the delimiter
+            if part_headers is None:
+                return
+            body = None
+            if lines is not None:
+                body = b"".join(lines)[:end - start]
+            parts.append(MhtPart(path, part_headers, start, end, body))
+
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                finish_part()
+                break
+
+            if line.startswith(delimiter):
+                rest = strip_newline(line[len(delimiter):]).rstrip()
+                if rest in (b"", b"--"):
+                    finish_part()
+                    part_headers = None
+                    if rest == b"--":
+                        break
+                    part_headers = read_headers(f)
+                    start = end = f.tell()
+                    lines = [] if part_headers.get_content_type() == "text/html" else None
+                    continue
+
+            if part_headers is not None:
+                end = offset + len(strip_newline(line))
+                if lines is not None:
+                    lines.append(line)
+
+        return headers, parts
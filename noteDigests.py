@@ -0,0 +1,129 @@
+"""
+Duplicate note detection for --dedup.
+
+A note's digest covers its title, its body and the MD5s of its attachments,
+in order, after normalizing the text: unicode NFC form, runs of whitespace
+as one space and no leading or trailing whitespace. Notes with the same
+digest are the same note as far as Evernote's import is concerned, only the
+first one is written.
+
+The digests seen so far are kept in a DigestSet, an open addressing hash
+table of 16 byte slots in a memory mapped temporary file, so millions of
+notes take tens of megabytes of disk and whatever of it the OS keeps cached,
+instead of a Python object each. Worker processes share a DigestSet through
+a DigestManager.
+"""
+import re, mmap, hashlib, tempfile, threading, unicodedata
+from multiprocessing.managers import BaseManager
+
+digestSize = 16
+# an empty slot, blake2b won't produce this digest in practice
+emptySlot = bytes(digestSize)
+spaces = re.compile(r"\s+")
+
+def normalize(text):
+    return spaces.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+def noteDigest(title, body, attachmentHashes=()):
+    "Digest of a note's title and body, and the hex MD5s of its attachments"
+    digest = hashlib.blake2b(digest_size=digestSize)
+    for text in (title, body):
+        digest.update(normalize(text).encode("utf-8"))
+        digest.update(b"\0")
+    for md5 in attachmentHashes:
+        digest.update(md5.encode("ascii"))
+        digest.update(b"\0")
+    return digest.digest()
+
+class DigestSet:
+    """
+    A set of digests in a temporary file, removed by close(). The table
+    doubles once it is half full. Safe to use from several threads
+    """
+    def __init__(self, capacity=1 << 16, directory=None):
+        self.directory = directory
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file, self.table, self.capacity = self.newTable(capacity)
+
+    def newTable(self, capacity):
+        f = tempfile.TemporaryFile(prefix="noteDigests-", dir=self.directory)
+        f.truncate(capacity * digestSize)
+        return f, mmap.mmap(f.fileno(), capacity * digestSize), capacity
+
+    def findSlot(self, table, capacity, digest):
+        "Offset of digest's slot in table, or of the empty slot it would go in, and what the slot holds"
+        i = int.from_bytes(digest[:8], "little") & (capacity - 1)
+        while True:
+            offset = i * digestSize
+            found = table[offset:offset + digestSize]
+            if found == digest or found == emptySlot:
+                return offset, found
+            i = (i + 1) & (capacity - 1)
+
+    def contains(self, digest):
+        with self.lock:
+            return self.findSlot(self.table, self.capacity, digest)[1] == digest
+
+    __contains__ = contains
+
+    def add(self, digest):
+        "Adds digest, returns False when it was in the set already"
+        with self.lock:
+            offset, found = self.findSlot(self.table, self.capacity, digest)
+            if found == digest:
+                return False
+            self.table[offset:offset + digestSize] = digest
+            self.count += 1
+            if self.count * 2 > self.capacity:
+                self.grow()
+            return True
+
+    def discard(self, digest):
+        "Removes digest, returns False when it wasn't in the set"
+        with self.lock:
+            offset, found = self.findSlot(self.table, self.capacity, digest)
+            if found != digest:
+                return False
+            # move the digests after it back, so that none of them is left
+            # behind an empty slot between it and its own slot
+            hole = offset // digestSize
+            i = hole
+            while True:
+                i = (i + 1) & (self.capacity - 1)
+                moved = self.table[i * digestSize:(i + 1) * digestSize]
+                if moved == emptySlot:
+                    break
+                home = int.from_bytes(moved[:8], "little") & (self.capacity - 1)
+                # stays when its slot is cyclically in (hole, i]
+                if (hole < i and hole < home <= i) or (hole > i and (home > hole or home <= i)):
+                    continue
+                self.table[hole * digestSize:(hole + 1) * digestSize] = moved
+                hole = i
+            self.table[hole * digestSize:(hole + 1) * digestSize] = emptySlot
+            self.count -= 1
+            return True
+
+    def grow(self):
+        f, table, capacity = self.newTable(self.capacity * 2)
+        for offset in range(0, len(self.table), digestSize):
+            digest = self.table[offset:offset + digestSize]
+            if digest != emptySlot:
+                newOffset, _ = self.findSlot(table, capacity, digest)
+                table[newOffset:newOffset + digestSize] = digest
+        self.table.close()
+        self.file.close()
+        self.file, self.table, self.capacity = f, table, capacity
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.table.closed: return
+        self.table.close()
+        self.file.close()
+
+class DigestManager(BaseManager):
+    "Serves a DigestSet to worker processes: manager.DigestSet() returns a proxy that pickles"
+
+DigestManager.register("DigestSet", DigestSet, exposed=("add", "contains", "discard", "close"))
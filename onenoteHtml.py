@@ -0,0 +1,324 @@
+"""
+Single pass reader for the html page of a OneNote section.
+
+OneNote exports every note of a section as a <div> in <body>, holding one
+element whose children are the note's title, its date and then its
+contents. read_notes() goes through the html.parser events once, without
+building a tree: the title and date are collected as text and the contents
+are cleaned and serialized as they go by.
+
+The result is the same as parsing the page with BeautifulSoup's
+"html.parser" backend and calling prettify() on each content element: the
+same rules for unclosed and stray tags, the same entity handling, sorted
+attributes, minimal escaping and one tag or string per line.
+"""
+import re, codecs
+from html.entities import html5
+from html.parser import HTMLParser
+
+void_elements = {
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr", "image", "img",
+    "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+}
+# whitespace in these is kept as it is, and their contents are not put on separate lines
+preserve_whitespace = {"pre", "textarea"}
+# strings in these are not part of the text of the element around them
+string_containers = {"rt", "rp", "style", "script", "template"}
+# strings directly in these are written without escaping
+unescaped_text = {"script", "style"}
+ascii_spaces = "\x20\x0a\x09\x0c\x0d"
+
+# the same order of guesses as BeautifulSoup's encoding detection, less its
+# character set sniffing library
+byte_order_marks = [
+    (codecs.BOM_UTF32_LE, "utf-32le"),
+    (codecs.BOM_UTF32_BE, "utf-32be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16le"),
+    (codecs.BOM_UTF16_BE, "utf-16be"),
+]
+xml_encoding = re.compile(b"^\\s*<\\?.*encoding=['\"](.*?)['\"].*\\?>", re.I)
+html_meta_charset = re.compile(b"<\\s*meta[^>]+charset\\s*=\\s*[\"']?([^>]*?)[ /;'\">]", re.I)
+
+def declared_encoding(data):
+    match = xml_encoding.search(data, 0, 1024) or html_meta_charset.search(data, 0, max(2048, len(data) // 20))
+    if match and match.group(1):
+        return match.group(1).decode("ascii", "replace").lower()
+    return None
+
+def decode_html(data):
+    "Decodes the bytes of an html part, trying its byte order mark, its declared encoding, utf-8 and windows-1252"
+    for mark, encoding in byte_order_marks:
+        if data.startswith(mark):
+            return data[len(mark):].decode(encoding, "replace")
+
+    for encoding in (declared_encoding(data), "utf-8", "windows-1252"):
+        if encoding:
+            try:
+                return data.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                pass
+    return data.decode("utf-8", "replace")
+
+def char_reference(number):
+    if number == 0 or number > 0x10ffff or 0xd800 <= number <= 0xdfff:
+        return "\ufffd"
+    if 0x80 <= number <= 0x9f:
+        try:
+            return bytes([number]).decode("windows-1252")
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def quote_attribute(value):
+    value = escape(value)
+    if '"' not in value:
+        return '"' + value + '"'
+    if "'" not in value:
+        return "'" + value + "'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+class RawNote:
+    """
+    A note as found in the page: elements holds the text of the title, the
+    text of the date and the html of each content element, or is None when
+    the note's <div> has no elements at all. attr_names lists the names of
+    the attributes found on the content elements, before cleaning
+    """
+    def __init__(self):
+        self.elements = None
+        self.attr_names = {}
+
+class Element:
+    __slots__ = ("name", "text", "out", "depth", "note", "index", "is_note", "is_base")
+
+    def __init__(self, name):
+        self.name = name
+        # the list collecting the text of the title or date this element is in
+        self.text = None
+        # the list collecting the html of the content element this element is in
+        self.out = None
+        self.depth = 0
+        self.note = None
+        self.index = None
+        self.is_note = False
+        self.is_base = False
+
+class NoteParser(HTMLParser):
+    def __init__(self, clean_attrs):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.clean_attrs = clean_attrs
+        self.notes = []
+        self.root = Element(None)
+        self.stack = [self.root]
+        self.open_names = {}
+        self.data = []
+        self.preserved = 0
+        self.containers = 0
+        # void elements closed without waiting for their end tag, a later
+        # end tag for one of them is dropped
+        self.already_closed = []
+        self.html = None
+        self.body = None
+        # the element that switched off one line per tag, a <pre> or <textarea>
+        self.literal = None
+
+    def close(self):
+        HTMLParser.close(self)
+        self.end_data()
+        while len(self.stack) > 1:
+            self.pop()
+
+    def push(self, name, attrs):
+        parent = self.stack[-1]
+        element = Element(name)
+        note = parent.note
+        if parent.out is not None:
+            element.out = parent.out
+            element.depth = parent.depth + 1
+        elif parent.text is not None:
+            element.text = parent.text
+        elif parent.is_base:
+            element.index = len(note.elements)
+            note.elements.append(None)
+            if element.index < 2:
+                element.text = []
+            else:
+                element.out = []
+        elif parent.is_note and note.elements is None:
+            element.is_base = True
+            note.elements = []
+        elif parent is self.body and name == "div":
+            element.is_note = True
+            note = RawNote()
+        elif name == "html" and self.html is None:
+            self.html = element
+        elif name == "body" and self.body is None and self.html is not None and self.html in self.stack:
+            self.body = element
+        element.note = note
+
+        self.stack.append(element)
+        self.open_names[name] = self.open_names.get(name, 0) + 1
+        if name in preserve_whitespace:
+            self.preserved += 1
+        if name in string_containers:
+            self.containers += 1
+
+        if element.out is not None:
+            self.write_start(element, attrs)
+
+    def write_start(self, element, attrs):
+        names = element.note.attr_names
+        for key in attrs:
+            names.setdefault(key, True)
+
+        attrs = self.clean_attrs(attrs, element.depth)
+        tag = "<" + element.name
+        for key in sorted(attrs):
+            tag += " " + key + "=" + quote_attribute(attrs[key])
+
+        if element.name in void_elements:
+            self.write_piece(tag + "/>", element.out)
+        elif self.literal is None and element.name in preserve_whitespace:
+            element.out.append(tag + ">")
+            self.literal = element
+        else:
+            self.write_piece(tag + ">", element.out)
+
+    def write_piece(self, piece, out, strip=True):
+        if self.literal is not None:
+            out.append(piece)
+            return
+        if strip:
+            piece = piece.strip()
+        if piece:
+            out.append(piece)
+            out.append("\n")
+
+    def pop(self):
+        element = self.stack.pop()
+        name = element.name
+        self.open_names[name] -= 1
+        if name in preserve_whitespace:
+            self.preserved -= 1
+        if name in string_containers:
+            self.containers -= 1
+
+        if element.out is not None and name not in void_elements:
+            if self.literal is element:
+                element.out.append("</" + name + ">\n")
+                self.literal = None
+            else:
+                self.write_piece("</" + name + ">", element.out, False)
+
+        if element.index is not None:
+            parts = element.text if element.text is not None else element.out
+            element.note.elements[element.index] = "".join(parts)
+        if element.is_note:
+            self.notes.append(element.note)
+
+    def pop_to(self, name):
+        if not self.open_names.get(name):
+            return
+        while self.stack[-1].name != name:
+            self.pop()
+        self.pop()
+
+    def end_data(self, prefix=None, suffix=""):
+        """
+        Adds the text collected since the last tag to the element it is in,
+        as a string, or as a comment or other markup when prefix is given
+        """
+        if not self.data:
+            return
+        data = "".join(self.data)
+        self.data = []
+        if not self.preserved and not data.strip(ascii_spaces):
+            data = "\n" if "\n" in data else " "
+
+        element = self.stack[-1]
+        if element.text is not None and (prefix == "<![CDATA[" or (prefix is None and not self.containers)):
+            element.text.append(data)
+        if element.out is not None:
+            if prefix is not None:
+                self.write_piece(prefix + data + suffix, element.out)
+            elif element.name in unescaped_text:
+                self.write_piece(data, element.out)
+            else:
+                self.write_piece(escape(data), element.out)
+
+    def handle_starttag(self, tag, attrs, self_closing=False):
+        self.end_data()
+        values = {}
+        for key, value in attrs:
+            values[key] = "" if value is None else value
+        self.push(tag, values)
+
+        if tag in void_elements and not self_closing:
+            self.pop_to(tag)
+            self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, True)
+        self.end_data()
+        self.pop_to(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.already_closed:
+            self.already_closed.remove(tag)
+            return
+        self.end_data()
+        self.pop_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if name[0] in "xX":
+            self.data.append(char_reference(int(name[1:], 16)))
+        else:
+            self.data.append(char_reference(int(name)))
+
+    def handle_entityref(self, name):
+        self.data.append(html5.get(name + ";") or html5.get(name) or "&" + name)
+
+    def handle_comment(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data("<!--", "-->")
+
+    def handle_decl(self, decl):
+        self.end_data()
+        self.data.append(decl[len("DOCTYPE "):])
+        self.end_data("<!DOCTYPE ", ">\n")
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith("CDATA["):
+            self.data.append(data[len("CDATA["):])
+            self.end_data("<![CDATA[", "]]>")
+        else:
+            self.data.append(data)
+            self.end_data("<?", "?>")
+
+    def handle_pi(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data("<?", ">")
+
+def read_notes(html, clean_attrs):
+    """
+    Returns a RawNote for each <div> in the <body> of html. clean_attrs is
+    called with the attributes of each content element as a dict and its
+    depth below the content element it is in, and returns the attributes to
+    keep
+    """
+    parser = NoteParser(clean_attrs)
+    parser.feed(html)
+    parser.close()
+    if parser.body is None:
+        raise ValueError("no <html><body> found")
+    return parser.notes
@@ -1,23 +1,64 @@
-import email, os, sys, argparse, re, operator, codecs, base64, glob
+import os, sys, argparse, re, operator, base64, glob, hashlib, contextlib
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup
-from mako.template import Template
+import enexTemplates, mhtReader, onenoteHtml, instrument, outputSink, noteDigests
 
-args = None
+# the options of the conversion running in a worker process, see init_worker
+worker_options = None
+# the DigestSet the worker processes share for --dedup
+worker_digests = None
 attr_whitelist = ["src", "alt", "height", "width", "type", "title", "summary", "href", "rel"] # "value"
 done = {}
+# stands in for the data URI of a media part in a note's contents until the
+# note is written, see write_with_media. Private use characters don't turn up
+# in OneNote's html
+media_token = "\ue000%i\ue000"
+media_token_re = re.compile("\ue000(\\d+)\ue000".encode("utf-8"))
+media_token_text_re = re.compile("\ue000(\\d+)\ue000")
+spaces_re = re.compile(rb"[\n\r ]+")
+
+class MhtOptions:
+    """
+    Options of a conversion, see convert_mht. The defaults are those of the
+    command line, MhtOptions(singleEnex=True) changes one
+    """
+    author = "Anonymous"
+    addLabel = None
+    keepStyle = False
+    singleEnex = False
+    maxNoteBytes = 25 * 1024 * 1024
+    sort = "created"
+    jobs = 1
+    compress = None
+    compressLevel = 6
+    writeBufferKB = 64
+    dedup = False
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not hasattr(MhtOptions, name) or name.startswith("_"):
+                raise TypeError("unknown option: " + name)
+            setattr(self, name, value)
+
+    @classmethod
+    def from_args(cls, args):
+        "The options among the parsed command line arguments"
+        return cls(**dict((name, value) for name, value in vars(args).items() if hasattr(cls, name)))
 
 class Note:
-    def __init__(self, title, created, contents, updated=None):
+    def __init__(self, title, created, contents, options, updated=None, media=()):
         self.title = title
         self.contents = contents
+        # the media parts the tokens in contents refer to
+        self.media = media
         self.labels = []
-        if args.addLabel:
-            labels = args.addLabel.split(",")
+        if options.addLabel:
+            labels = options.addLabel.split(",")
             self.labels = labels
         self.created = created
         self.updated = updated or created
-        self.author = args.author
+        self.author = options.author
 
     def __str__(self):
         return "%s - %s" % (self.title, self.datestamp)
@@ -29,38 +70,10 @@ class Note:
         return datetime.strftime("%Y%m%dT%H%M%SZ")
 
     def to_html(self, heading="h2"):
-        return Template("""
-<div>
-<${heading}>${note.title}</${heading}>
-<div>${note.contents}</div>
-</div>""").render(note=self, heading=heading)
+        return enexTemplates.onenoteNoteHtml.render(note=self, heading=heading)
 
     def to_enex(self):
-        enexXML = Template("""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export4.dtd">
-<en-export application="Evernote" version="Evernote">
-    <note>
-        <title>${note.title}</title>
-        <created>${note.to_stamp(note.created)}</created>
-        <updated>${note.to_stamp(note.updated)}</updated>
-        <note-attributes>
-            <author>${note.author}</author>
-        </note-attributes>
-        % for label in note.labels:
-        <tag>${label}</tag>
-        % endfor
-        <content>
-            <![CDATA[<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-            <!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
-            <en-note>
-                <div>${note.contents}</div>
-            </en-note>
-            ]]>
-        </content>
-    </note>
-</en-export>
-""")
-        return enexXML.render(note=self)
+        return enexTemplates.onenoteNoteEnex.render(note=self)
 
 def normalize_style(style):
     style = whitespace(style)
@@ -74,80 +87,187 @@ def normalize_style(style):
 
     return ";".join(new_style)
 
-def strip_attrs(nodes):
-    # global args, attr_whitelist, done
+def strip_attrs(attrs, depth, keep_style=False):
+    new_attrs = {}
+    for key, value in attrs.items():
+        if key in attr_whitelist:
+            new_attrs[key] = whitespace(value)
 
-    if nodes and len(nodes) > 0:
-        for node in nodes:
-            if is_element(node):
-                style = node.attrs.get("style")
-                attrs = node.attrs.items()
-                node.attrs = {}
-
-                for key, value in attrs:
-                    if key in attr_whitelist:
-                        node.attrs[key] = whitespace(value)
-                    if key not in done:
-                        done[key] = True
-                        # print("has key: key)
-                        # print(node.prettify())
-
-                if style:
-                    if args.keepStyle:
-                        node.attrs["style"] = whitespace(style)
-                    else:
-                        node.attrs["style"] = normalize_style(style)
+    style = attrs.get("style")
+    if style:
+        if keep_style:
+            style = whitespace(style)
+        else:
+            style = normalize_style(style)
+        # elements more than one level into the contents used to be
+        # stripped twice, which dropped a style left empty
+        if style or depth < 2:
+            new_attrs["style"] = style
 
-                strip_attrs(node.findAll())
+    return new_attrs
 
 def whitespace(text):
     wreg = r'[\n\r ]+'
     return re.sub(wreg, " ", (text or "").strip())
 
-def is_element(node):
-    return node and node.name is not None
-
-def html_to_notes(html, media=[]):
+def index_media(media):
+    "Maps the file name of each media part to the part, the first part wins"
+    media_index = {}
+    for m in media:
+        location = m.get("content-location")
+        if location:
+            media_index.setdefault(os.path.basename(location), m)
+    return media_index
+
+def media_uri_prefix(m):
+    return ("data:" + m.get_content_type() + ";charset=urf-8;base64,").encode("ascii")
+
+def write_media_uri(m, write):
+    """
+    Writes the data URI of a media part, streaming its payload from the .mht
+    file the way it used to come out of the html cleanup: escaped as an
+    attribute value, with each run of line breaks and spaces as one space
+    """
+    write(media_uri_prefix(m))
+    after_space = False
+    for chunk in m.iter_body():
+        for char, entity in ((b"&", b"&amp;"), (b"<", b"&lt;"), (b">", b"&gt;"), (b'"', b"&quot;")):
+            if char in chunk:
+                chunk = chunk.replace(char, entity)
+        # base64 comes in lines ending in \r\n, replace() is much quicker than the regex
+        chunk = chunk.replace(b"\r\n", b" ")
+        if b"\n" in chunk or b"\r" in chunk or b"  " in chunk:
+            chunk = spaces_re.sub(b" ", chunk)
+        if after_space and chunk.startswith(b" "):
+            chunk = chunk[1:]
+        if chunk:
+            write(chunk)
+            after_space = chunk.endswith(b" ")
+
+def write_with_media(data, write, media):
+    "Writes the utf-8 bytes data, with each media token replaced by its part's data URI"
+    pieces = media_token_re.split(data)
+    write(pieces[0])
+    for i in range(1, len(pieces), 2):
+        write_media_uri(media[int(pieces[i])], write)
+        write(pieces[i + 1])
+
+def size_with_media(data, media, uri_sizes):
+    """
+    Size of data once write_with_media has put the data URIs in. The size of
+    each part's URI is worked out once, by streaming it, and kept in uri_sizes
+    """
+    size = len(data)
+    for match in media_token_re.finditer(data):
+        m = media[int(match.group(1))]
+        if m not in uri_sizes:
+            sizes = []
+            write_media_uri(m, lambda chunk: sizes.append(len(chunk)))
+            uri_sizes[m] = sum(sizes)
+        size += uri_sizes[m] - len(match.group(0))
+    return size
+
+def media_hash(m, media_hashes):
+    "MD5 of the data URI of a media part, worked out once per part and kept in media_hashes"
+    if m not in media_hashes:
+        md5 = hashlib.md5()
+        write_media_uri(m, md5.update)
+        media_hashes[m] = md5.hexdigest()
+    return media_hashes[m]
+
+def note_digest(note, media_hashes):
+    "The noteDigests digest of a note, with the MD5s of the media parts its tokens refer to"
+    hashes = []
+    def replace(match):
+        hashes.append(media_hash(note.media[int(match.group(1))], media_hashes))
+        return "\ue000"
+    with instrument.stage("hashing"):
+        return noteDigests.noteDigest(note.title, media_token_text_re.sub(replace, note.contents), hashes)
+
+def drop_duplicates(notes, digests):
+    """
+    Returns the notes whose digests weren't in digests yet, adding them, with
+    their digests and the number of notes dropped. Adding claims a digest at
+    once, also for sections converted at the same time, the caller discards
+    the digests of notes that fail to be written
+    """
+    media_hashes = {}
+    kept = []
+    kept_digests = []
+    for note in notes:
+        digest = note_digest(note, media_hashes)
+        if digests.add(digest):
+            kept.append(note)
+            kept_digests.append(digest)
+    return kept, kept_digests, len(notes) - len(kept)
+
+@contextlib.contextmanager
+def digest_set(options, shared=False):
+    """
+    The DigestSet for --dedup, or None without it. A shared set is kept in
+    a DigestManager's process, for worker processes to use through a proxy
+    """
+    if not options.dedup:
+        yield None
+        return
+    with contextlib.ExitStack() as stack:
+        if shared:
+            digests = stack.enter_context(noteDigests.DigestManager()).DigestSet()
+        else:
+            digests = noteDigests.DigestSet()
+        stack.callback(digests.close)
+        yield digests
 
-    soup = BeautifulSoup(html, "html.parser")
+def html_to_notes(html, options, media=[]):
     notes = []
     index = 0
+    media_index = index_media(media)
+    # the parts referenced by the section's notes, each gets a token the
+    # first time it turns up
+    media_parts = []
+    tokens = {}
+
+    def clean_attrs(attrs, depth):
+        attrs = strip_attrs(attrs, depth, options.keepStyle)
+        src = attrs.get("src")
+        if src is not None and len(media_index) > 0:
+            src = os.path.basename(src)
+            if src in media_index:
+                if src not in tokens:
+                    tokens[src] = media_token % len(media_parts)
+                    media_parts.append(media_index[src])
+                attrs["src"] = tokens[src]
+        return attrs
+
+    # title, date and cleaned contents of every note in one pass over the html
+    with instrument.stage("html sanitize"):
+        raw_notes = onenoteHtml.read_notes(onenoteHtml.decode_html(html), clean_attrs)
+
+    for raw_note in raw_notes:
+        try:
+            [title, date, *contents] = raw_note.elements
+
+            title = whitespace(title)
+            if len(contents) <= 0:
+                print("no contents: %i-%s" % (index, title))
+            date = whitespace(date.strip())
+            dtime = datetime.strptime(date, '%A, %B %d, %Y %I:%M %p').astimezone(timezone.utc)
+
+            for key in raw_note.attr_names:
+                done.setdefault(key, True)
+
+            html = whitespace("".join(contents))
+            note = Note(title, dtime, html, options, media=media_parts)
+            notes.append(note)
+            index += 1
+            instrument.count("notes")
+        except Exception as e:
+            print("ERROR in section", index)
+            print(e)
 
-    for child in soup.html.body.children:
-        if child.name == "div":
-            try:
-                base = [c for c in child.children if c.name is not None][0]
-                [title_node, date_node, *contents] = [c for c in base.contents if is_element(c)]
-
-                title = whitespace(title_node.get_text())
-                if len(contents) <= 0:
-                    print("no contents: %i-%s" % (index, title))
-                date = whitespace(date_node.get_text().strip())
-                dtime = datetime.strptime(date, '%A, %B %d, %Y %I:%M %p').astimezone(timezone.utc)
-                html = ""
-
-                strip_attrs(contents)
-
-                if len(media) > 0:
-                    elements = base.findAll(src=True)
-                    for element in elements:
-                        src = os.path.basename(element.attrs.get("src"))
-                        for m in media:
-                            name = os.path.basename(m.get("content-location"))
-                            if name == src:
-                                element.attrs["src"] = "data:" + m.get_content_type() + ";charset=urf-8;base64," + m.get_payload(decode=False)
-                                break
-
-                html = whitespace("".join([n.prettify() for n in contents]))
-                note = Note(title, dtime, html)
-                notes.append(note)
-                index += 1
-            except Exception as e:
-                print("ERROR in section", index)
-                print(e)
-
-    if args.sort:
-        notes.sort(key=operator.attrgetter(args.sort))
+    if options.sort:
+        # "datetime", the default once, is the time a note was created
+        notes.sort(key=operator.attrgetter("created" if options.sort == "datetime" else options.sort))
     else:
         print("skip sort")
 
@@ -163,7 +283,123 @@ def get_dates(notes):
     updated = dtimes[0]
     return [created, updated]
 
-def mht_to_html(mht_file_path):
+class SingleEnexWriter:
+    """
+    Writes all the notes of a section into one .enex file as one note, for
+    --singleEnex. The notes' html is streamed into the file a part at a
+    time: when the next note would take the note's contents past max_bytes
+    (0 for no limit), it is closed and the rest continues in a new note.
+    A section that needs more than one note gets "<name> - Part 1",
+    "<name> - Part 2" and so on, each dated by its own notes. Only the html
+    of the current part is held in memory. The file, <name>.enex in sink,
+    is started with the first part. For a compressed file each part is
+    rendered into a spool file first, see outputSink.spooled, and a file
+    that fails is discarded
+    """
+    def __init__(self, sink, name, options, max_bytes=0):
+        self.sink = sink
+        self.name = name
+        self.file_name = name + ".enex"
+        self.options = options
+        self.max_bytes = max_bytes
+        self.part_number = 0
+        self.part_notes = []
+        self.part_htmls = []
+        self.part_size = 0
+        # media part -> size of its data URI
+        self.uri_sizes = {}
+        self.outfile = None
+        # where write() goes, the file or the spool of the part being rendered
+        self.target = None
+
+    def write(self, text):
+        with instrument.stage("file write"):
+            self.target.write(text.encode("utf-8"))
+
+    def write_contents(self):
+        with instrument.stage("file write"):
+            for note, html in zip(self.part_notes, self.part_htmls):
+                write_with_media(html, self.target.write, note.media)
+
+    def add(self, note):
+        with instrument.stage("template render"):
+            html = note.to_html(heading="h2" if len(note.contents) > 0 else "h1").encode("utf-8")
+        # the size only matters with a limit, measuring it reads the media again
+        size = size_with_media(html, note.media, self.uri_sizes) if self.max_bytes else 0
+        if self.part_notes and self.max_bytes and self.part_size + size > self.max_bytes:
+            try:
+                self.write_part()
+            except BaseException:
+                self.discard()
+                raise
+        self.part_notes.append(note)
+        self.part_htmls.append(html)
+        self.part_size += size
+
+    def write_part(self, last=False):
+        self.part_number += 1
+        title = self.name
+        if not (last and self.part_number == 1):
+            title = "%s - Part %i" % (self.name, self.part_number)
+        [created, updated] = get_dates(self.part_notes)
+        part = Note(title, created, None, self.options, updated)
+        if self.sink.seekable:
+            self.open()
+            self.render_part(part)
+        else:
+            # the file is only started once its first part is complete
+            with outputSink.spooled(self.open) as spool:
+                self.target = spool
+                try:
+                    self.render_part(part)
+                finally:
+                    self.target = self.outfile
+        self.part_notes = []
+        self.part_htmls = []
+        self.part_size = 0
+
+    def open(self):
+        if self.outfile is None:
+            self.outfile = self.target = self.sink.open(self.file_name)
+            self.write(enexTemplates.exportHeader)
+        return self.outfile
+
+    def render_part(self, part):
+        from mako.runtime import Context
+        with instrument.stage("template render"):
+            context = Context(self, note=part, writeContents=self.write_contents)
+            enexTemplates.onenoteSectionNoteEnex.render_context(context)
+
+    def discard(self):
+        """
+        Drops the file after a failure. An entry of a zip can't be taken out
+        again, it is ended after the parts written so far, so that it parses
+        """
+        if self.outfile is None:
+            return
+        try:
+            if self.sink.keepsDiscarded:
+                self.target = self.outfile
+                self.write(enexTemplates.exportFooter)
+        finally:
+            self.sink.discard(self.file_name, self.outfile)
+            self.outfile = self.target = None
+
+    def close(self):
+        try:
+            self.write_part(last=True)
+            self.write(enexTemplates.exportFooter)
+        except BaseException:
+            # a section without notes leaves no file
+            self.discard()
+            raise
+        self.outfile.close()
+
+def mht_to_html(mht_file_path, options, digests=None):
+    """
+    Converts a .mht file next to it. Notes already in digests, a DigestSet,
+    are skipped, returns how many
+    """
     name = os.path.splitext(os.path.basename(mht_file_path))[0]
     dir_path = os.path.dirname(mht_file_path)
     html_file_path = os.path.join(dir_path, name + ".html")
@@ -173,74 +409,240 @@ def mht_to_html(mht_file_path):
     print("html file path:", html_file_path)
     notes = []
 
-    with open(mht_file_path, "rb") as mht_file:
-        msg = email.message_from_bytes(mht_file.read())
-        if msg.is_multipart():
-            htmls = []
-            media = []
-            for part in msg.get_payload():
-                if part.get_content_type() == "text/html":
-                    htmls.append(part.get_payload(decode=True))
-                else:
-                    print("has media", part.get_content_type(), part.get("content-location"))
-                    media.append(part)
-
-            if len(htmls) > 1:
-                print("multiple html parts!!!!")
+    # media parts stay in the file until their payload is inlined
+    with instrument.stage("MIME parse"):
+        msg, parts = mhtReader.read_mht(mht_file_path)
+    instrument.count("sections")
+    if msg.get_content_maintype() == "multipart":
+        htmls = []
+        media = []
+        for part in parts:
+            if part.get_content_type() == "text/html":
+                htmls.append(part.get_payload(decode=True))
             else:
-                notes = html_to_notes(htmls[0], media)
+                print("has media", part.get_content_type(), part.get("content-location"))
+                media.append(part)
+                instrument.count("media parts")
+
+        if len(htmls) > 1:
+            print("multiple html parts!!!!")
         else:
-            notes = html_to_notes(msg.get_payload(decode=True))
-
-    if args.singleEnex:
-        outpath = os.path.join(dir_path, name + ".enex")
-        print(outpath)
-        html = "".join([note.to_html(heading="h2" if len(note.contents) > 0 else "h1") for note in notes])
-        [created, updated] = get_dates(notes)
-        note = Note(name, created, html, updated)
-        with codecs.open(outpath, 'w', 'utf-8') as outfile:
-            outfile.write(note.to_enex())
-        print("finished '%s'" % outpath)
+            notes = html_to_notes(htmls[0], options, media)
     else:
-        outpath = os.path.join(dir_path, "Evernote_Files_" + name)
-        print("outpath:", outpath)
-        try:
-            os.mkdir(outpath)
+        notes = html_to_notes(parts[0].get_payload(decode=True), options)
+
+    duplicates = 0
+    note_digests = []
+    if digests is not None:
+        notes, note_digests, duplicates = drop_duplicates(notes, digests)
+        instrument.count("duplicates", duplicates)
+        if duplicates:
+            print("skipped %i duplicate notes" % duplicates)
+        if duplicates and not notes:
+            print("finished '%s' - all its notes are duplicates" % mht_file_path)
+            return duplicates
+
+    # notes written so far, a note that isn't gives its digest back for a later copy
+    written = 0
+    try:
+        buffer_size = options.writeBufferKB * 1024
+        if options.singleEnex:
+            # next to the .mht file, or in <name>.zip
+            sink_dir = os.path.join(dir_path, name) if options.compress == "zip" else dir_path
+            sink = outputSink.openSink(sink_dir, options.compress, options.compressLevel, buffer_size)
+            outpath = sink.path(name + ".enex")
+            print(outpath)
+            try:
+                writer = SingleEnexWriter(sink, name, options, options.maxNoteBytes)
+                for note in notes:
+                    writer.add(note)
+                writer.close()
+            finally:
+                sink.close()
+            written = len(notes)
+            if writer.part_number > 1:
+                print("split into %i notes" % writer.part_number)
+            print("finished '%s'" % outpath)
+        else:
+            outpath = os.path.join(dir_path, "Evernote_Files_" + name)
+            print("outpath:", outpath)
+            if options.compress != "zip":
+                try:
+                    os.mkdir(outpath)
+                except Exception as e:
+                    print(e)
+
+            sink = outputSink.openSink(outpath, options.compress, options.compressLevel, buffer_size)
+            try:
+                for i, note in enumerate(notes):
+                    with instrument.stage("template render"):
+                        xml = note.to_enex().encode("utf-8")
+                    with instrument.stage("file write"), sink.writeFile(str(i + 1) + ".enex") as outfile:
+                        write_with_media(xml, outfile.write, note.media)
+                    written = i + 1
+            finally:
+                sink.close()
+            print("finished '%s' - %i enex files created" % (mht_file_path, len(notes)))
+    except BaseException:
+        for digest in note_digests[written:]:
+            digests.discard(digest)
+        raise
+    return duplicates
+
+class MhtResult:
+    "Outcome of converting one .mht file in a worker process"
+    def __init__(self, path, error=None, attributes=(), stats=None, duplicates=0):
+        self.path = path
+        # exceptions are sent back as text, they don't all pickle
+        self.error = error
+        # attribute names found in the file, in the order they were found
+        self.attributes = attributes
+        # stage timings, see instrument.collect
+        self.stats = stats
+        self.duplicates = duplicates
+
+def init_worker(options, report, digests=None):
+    global worker_options, worker_digests
+    worker_options = options
+    worker_digests = digests
+    if report:
+        instrument.enable()
+
+def mht_to_html_in_worker(path):
+    done.clear()
+    error = None
+    duplicates = 0
+    try:
+        print("importing: ", path)
+        duplicates = mht_to_html(path, worker_options, worker_digests)
+    except Exception as e:
+        error = str(e)
+    return MhtResult(path, error, list(done), instrument.collect(), duplicates)
+
+def mht_dir_to_enex(mht_dir_path, options):
+    "Converts every .mht file in a directory, returns the number of duplicate notes skipped"
+    paths = glob.glob(os.path.join(mht_dir_path, "*.mht"))
+
+    with digest_set(options, shared=options.jobs > 1) as digests:
+        duplicates = mht_files_to_enex(paths, options, digests)
+    if digests is not None:
+        print("duplicate notes skipped: %i" % duplicates)
+    return duplicates
+
+def convert_in_pool(tasks, options, digests, jobs, report):
+    """
+    Converts the .mht files in the list tasks in a pool of jobs worker
+    processes, a file per task and no more than jobs at a time, and passes
+    each MhtResult to report. A worker that dies, killed for running out of
+    memory say, breaks the pool: returns the files that were being
+    converted then, the files not started yet are left in tasks
+    """
+    running = {}
+    initargs = (options, instrument.enabled, digests)
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=initargs) as executor:
+        while tasks or running:
+            while tasks and len(running) < jobs:
+                path = tasks.pop(0)
+                try:
+                    future = executor.submit(mht_to_html_in_worker, path)
+                except BrokenProcessPool as e:
+                    future = Future()
+                    future.set_exception(e)
+                running[future] = path
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in finished:
+                path = running.pop(future)
+                try:
+                    report(future.result())
+                except BrokenProcessPool:
+                    broken.append(path)
+            if broken:
+                # the pool takes the files the other workers were on down with it
+                for future, path in running.items():
+                    try:
+                        report(future.result())
+                    except BrokenProcessPool:
+                        broken.append(path)
+                return broken
+    return []
+
+def mht_files_to_enex(paths, options, digests):
+    duplicates = 0
+    if options.jobs > 1:
+        results = {}
+
+        def report(result):
+            instrument.merge(result.stats)
+            results[result.path] = result
+            if result.error is not None:
+                print("error importing %s" % result.path)
+                print(result.error)
+            print("converted %i/%i: %s" % (len(results), len(paths), result.path))
+
+        # one file per task, largest first so that a big section doesn't start last
+        tasks = sorted(paths, key=os.path.getsize, reverse=True)
+        while tasks:
+            broken = convert_in_pool(tasks, options, digests, options.jobs, report)
+            for path in broken:
+                # again one file to a pool, so that only the file that kills its worker fails
+                if len(broken) == 1 or convert_in_pool([path], options, digests, 1, report):
+                    report(MhtResult(path, "the worker process converting it died"))
+
+        # the attribute summary lists the files' attributes in the same order as a serial run
+        for path in paths:
+            for key in results[path].attributes:
+                done.setdefault(key, True)
+        return sum(result.duplicates for result in results.values())
+
+    for i, path in enumerate(paths):
+        try: 
+            print("importing: ", path)
+            duplicates += mht_to_html(path, options, digests)
         except Exception as e:
+            print("error importing %s" % path)
             print(e)
-
-        for i, note in enumerate(notes):
-            outfname = os.path.join(outpath, str(i + 1) + ".enex")
-            # print(outfname, i)
-            xml = note.to_enex()
-            with codecs.open(outfname, 'w', 'utf-8') as outfile:
-                outfile.write(xml)
-        print("finished '%s' - %i enex files created" % (mht_file_path, len(notes)))
-
-def getArgs():
+        print("converted %i/%i: %s" % (i + 1, len(paths), path))
+    return duplicates
+
+def convert_mht(path, options=None):
+    """
+    Converts a OneNote .mht file, or every .mht file in a directory, next to
+    it. options is an MhtOptions. Returns the number of duplicate notes
+    skipped with dedup. The templates are kept for the next call
+    """
+    options = options or MhtOptions()
+    if os.path.isdir(path):
+        return mht_dir_to_enex(path, options)
+    with digest_set(options) as digests:
+        return mht_to_html(path, options, digests)
+
+def getArgs(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("mht_dir_path")
-    parser.add_argument("--author", default="Anonymous")
-    parser.add_argument("--addLabel", default=None)
-    parser.add_argument("--keepStyle", default=False)
-    parser.add_argument("--singleEnex", default=False)
-    parser.add_argument("--sort", default="datetime")
-    return parser.parse_args()
+    parser.add_argument("--author", default=MhtOptions.author)
+    parser.add_argument("--addLabel", default=MhtOptions.addLabel)
+    parser.add_argument("--keepStyle", default=MhtOptions.keepStyle)
+    parser.add_argument("--singleEnex", default=MhtOptions.singleEnex)
+    parser.add_argument("--maxNoteBytes", default=MhtOptions.maxNoteBytes, type=int,
+                        help="with --singleEnex, continue in a new note once a note's contents reach this size, 0 for no limit")
+    parser.add_argument("--sort", default=MhtOptions.sort)
+    parser.add_argument("--jobs", default=MhtOptions.jobs, type=int, help="convert this many .mht files at a time in worker processes")
+    parser.add_argument("--compress", default=MhtOptions.compress, choices=outputSink.compressions,
+                        help="write .enex.gz files, or a .zip per section")
+    parser.add_argument("--compressLevel", default=MhtOptions.compressLevel, type=int)
+    parser.add_argument("--writeBufferKB", default=MhtOptions.writeBufferKB, type=int)
+    parser.add_argument("--dedup", default=MhtOptions.dedup, help="skip notes with the same title, contents and media as one already written")
+    parser.add_argument("--report", default=None, help="write per-stage timings as json to this file")
+    parser.add_argument("--profile", default=None, help="write a cProfile dump of the run to this file")
+    return parser.parse_args(argv)
 
 def main():
-    global args
     args = getArgs()
 
     print(vars(args))
 
-    # TODO: get mht files
-    for path in glob.glob(os.path.join(args.mht_dir_path, "*.mht")):
-        try: 
-            print("importing: ", path)
-            mht_to_html(path)
-        except Exception as e:
-            print("error importing %s" % path)
-            print(e)
+    instrument.run(lambda: mht_dir_to_enex(args.mht_dir_path, MhtOptions.from_args(args)), args.report, args.profile)
 
     print("attributes: ", list(done.keys()))
 ##    try:
@@ -0,0 +1,126 @@
+"""
+Where the converters write their .enex files.
+
+A sink hands out a binary file object per output file: FileSink writes plain
+files to a directory, GzipSink writes each file gzip compressed with .gz
+added to its name, and ZipSink writes all of them as the entries of a single
+zip file. Either way the output is compressed as it is written, in one pass.
+
+Compressed files can't be rewound, so writers that take back a partly
+written note only do so with a seekable sink, see FileSink.seekable, and
+render notes for the others through spooled() first. A discarded file is
+removed, except from a zip, see ZipSink.keepsDiscarded.
+"""
+import os, io, gzip, shutil, tempfile, contextlib
+from zipfile import ZipFile, ZIP_DEFLATED
+
+compressions = ["gzip", "zip"]
+# notes are spooled in memory up to this size, and in a temporary file past it
+noteSpoolSize = 16 * 1024 * 1024
+
+@contextlib.contextmanager
+def spooled(openFile, chunkSize=0):
+    """
+    Gives a file to render a note into. Once the block completes, the note is
+    copied to the file openFile() returns, a note that fails leaves nothing
+    """
+    with tempfile.SpooledTemporaryFile(noteSpoolSize) as spool:
+        yield spool
+        spool.seek(0)
+        shutil.copyfileobj(spool, openFile(), chunkSize)
+
+class Sink:
+    @contextlib.contextmanager
+    def writeFile(self, name):
+        """
+        Gives a file to write the file name with, which is only kept when the
+        block completes: directly for a seekable sink, discarded again on
+        failure, or through spooled()
+        """
+        if not self.seekable:
+            with contextlib.ExitStack() as stack, spooled(lambda: stack.enter_context(self.open(name))) as spool:
+                yield spool
+            return
+        f = self.open(name)
+        try:
+            yield f
+        except BaseException:
+            self.discard(name, f)
+            raise
+        f.close()
+
+class FileSink(Sink):
+    "Writes each file to directory as it is"
+    seekable = True
+    keepsDiscarded = False
+    suffix = ""
+
+    def __init__(self, directory, bufferSize=io.DEFAULT_BUFFER_SIZE):
+        self.directory = directory
+        self.bufferSize = bufferSize
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.suffix)
+
+    def open(self, name):
+        return open(self.path(name), "wb", buffering=self.bufferSize)
+
+    def discard(self, name, f):
+        "Closes and removes a file that isn't to be kept"
+        f.close()
+        os.remove(self.path(name))
+
+    def close(self):
+        pass
+
+class GzipSink(FileSink):
+    "Writes each file to directory gzip compressed, as name.gz"
+    seekable = False
+    suffix = ".gz"
+
+    def __init__(self, directory, level=6, bufferSize=io.DEFAULT_BUFFER_SIZE):
+        FileSink.__init__(self, directory, bufferSize)
+        self.level = level
+
+    def open(self, name):
+        # GzipFile compresses every write it's given, the buffer gathers small ones
+        return io.BufferedWriter(gzip.GzipFile(self.path(name), "wb", self.level), self.bufferSize)
+
+class ZipSink(Sink):
+    """
+    Writes the files as the entries of the zip file at path, one at a time.
+    An entry can't be taken out of the zip again, a discarded one is left
+    as far as it was written
+    """
+    seekable = False
+    keepsDiscarded = True
+
+    def __init__(self, path, level=6, bufferSize=io.DEFAULT_BUFFER_SIZE):
+        self.zipPath = path
+        self.bufferSize = bufferSize
+        self.zipFile = ZipFile(path, "w", ZIP_DEFLATED, compresslevel=level)
+
+    def path(self, name):
+        return self.zipPath + "/" + name
+
+    def open(self, name):
+        return io.BufferedWriter(self.zipFile.open(name, "w", force_zip64=True), self.bufferSize)
+
+    def discard(self, name, f):
+        f.close()
+
+    def close(self):
+        self.zipFile.close()
+
+def openSink(directory, compress=None, level=6, bufferSize=io.DEFAULT_BUFFER_SIZE):
+    """
+    Returns the sink for the files that would go into directory: directory
+    itself, or directory.zip for compress="zip"
+    """
+    if compress == "gzip":
+        return GzipSink(directory, level, bufferSize)
+    if compress == "zip":
+        return ZipSink(directory + ".zip", level, bufferSize)
+    if compress:
+        raise ValueError("unknown compression: %s" % compress)
+    return FileSink(directory, bufferSize)